@@ -0,0 +1,86 @@
+# Measures bulk ingestion throughput against the old one-commit-per-item path.
+#
+#   python -m benchmark.bulk --rows 200000
+import io
+import json
+import random
+import argparse
+import pathlib
+import tempfile
+import time
+
+from bulk import BulkIngester, parse_jsonl
+from database import ConnectionPool, UPSERT_CATEGORY, INSERT_ITEM, SELECT_CATEGORY_ID
+from benchmark.fts import WORDS, CATEGORIES
+from migrations import migrate
+
+
+def make_jsonl(rows: int, seed: int = 0) -> bytes:
+    rng = random.Random(seed)
+    out = io.StringIO()
+    for _ in range(rows):
+        item = {
+            "name": " ".join(rng.choices(WORDS, k=rng.randint(2, 4))),
+            "category": rng.choice(CATEGORIES),
+            "image_name": f"{rng.getrandbits(256):064x}.jpg",
+        }
+        out.write(json.dumps(item, ensure_ascii=False) + "\n")
+    return out.getvalue().encode()
+
+
+def fresh_pool(directory: str, name: str) -> ConnectionPool:
+    pool = ConnectionPool(pathlib.Path(directory) / name, size=1)
+    with pool.connection() as conn:
+        migrate(conn)
+    return pool
+
+
+def bulk(pool: ConnectionPool, body: bytes, chunk_size: int) -> float:
+    with pool.connection() as conn:
+        start = time.perf_counter()
+        ingester = BulkIngester(conn, chunk_size)
+        ingester.ingest(parse_jsonl(io.BytesIO(body)))
+        elapsed = time.perf_counter() - start
+    assert ingester.failed == 0
+    return ingester.inserted / elapsed
+
+
+def per_item(pool: ConnectionPool, body: bytes) -> float:
+    # what insert_item_by_db does: category lookup, insert, commit for every item
+    with pool.connection() as conn:
+        start = time.perf_counter()
+        count = 0
+        for _, item in parse_jsonl(io.BytesIO(body)):
+            row = conn.execute(SELECT_CATEGORY_ID, (item["category"],)).fetchone()
+            if row is None:
+                conn.execute(UPSERT_CATEGORY, (item["category"],))
+                row = conn.execute(SELECT_CATEGORY_ID, (item["category"],)).fetchone()
+            category_id = row[0]
+            conn.execute(INSERT_ITEM, (item["name"], category_id, item["image_name"]))
+            conn.commit()
+            count += 1
+        return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="bulk ingestion benchmark")
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--baseline-rows", type=int, default=5_000, help="rows for the per-item baseline")
+    parser.add_argument("--chunk-size", type=int, nargs="+", default=[1_000, 5_000, 20_000, 50_000])
+    args = parser.parse_args()
+
+    body = make_jsonl(args.rows)
+    with tempfile.TemporaryDirectory() as tmp:
+        pool = fresh_pool(tmp, "baseline.sqlite3")
+        rate = per_item(pool, make_jsonl(args.baseline_rows, seed=1))
+        pool.close()
+        print(f"per-item commits   {args.baseline_rows:>9} rows {rate:>12,.0f} items/s")
+        for chunk_size in args.chunk_size:
+            pool = fresh_pool(tmp, f"bulk-{chunk_size}.sqlite3")
+            rate = bulk(pool, body, chunk_size)
+            pool.close()
+            print(f"bulk chunk={chunk_size:<7} {args.rows:>9} rows {rate:>12,.0f} items/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# Compares the old LIKE '%keyword%' scan with the items_fts index used by /search.
+#
+#   python -m benchmark.fts --rows 10000 100000 1000000
+import random
+import sqlite3
+import argparse
+import pathlib
+import tempfile
+import statistics
+import time
+
+from database import SEARCH_ITEMS, SEARCH_ITEMS_FTS, SEARCH_ITEMS_RANKED
+from search import fts_phrase
+from migrations import migrate
+
+
+WORDS = [
+    "jacket", "coat", "shirt", "sneakers", "bag", "watch", "camera", "lens",
+    "black", "white", "vintage", "leather", "wool", "denim", "cotton", "mini",
+    "ジャケット", "コート", "スニーカー", "バッグ", "時計", "カメラ", "黒", "白", "革", "古着",
+]
+CATEGORIES = ["fashion", "shoes", "bags", "electronics", "ファッション", "家電"]
+KEYWORDS = ["jacket", "leather", "ジャケット", "camera", "zzz-no-match"]
+
+
+def build_database(path: pathlib.Path, rows: int, seed: int = 0):
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    migrate(conn)
+    conn.executemany("INSERT INTO categories (name) VALUES (?)", [(name,) for name in CATEGORIES])
+    batch = []
+    for _ in range(rows):
+        name = " ".join(rng.choices(WORDS, k=rng.randint(2, 4)))
+        batch.append((name, rng.randint(1, len(CATEGORIES)), "default.jpg"))
+        if len(batch) == 10000:
+            conn.executemany("INSERT INTO items (name, category_id, image_name) VALUES (?, ?, ?)", batch)
+            batch.clear()
+    conn.executemany("INSERT INTO items (name, category_id, image_name) VALUES (?, ?, ?)", batch)
+    conn.commit()
+    return conn
+
+
+def time_query(conn: sqlite3.Connection, query: str, params: tuple, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        found = len(conn.execute(query, params).fetchall())
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000, found
+
+
+def run(rows: int, repeat: int, page: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = build_database(pathlib.Path(tmp) / "bench.sqlite3", rows)
+        print(f"\n{rows} items (median of {repeat} runs, ms)")
+        print(f"{'keyword':<14}{'matches':>9}{'like page':>12}{'fts page':>11}{'ranked page':>13}{'like all':>11}{'fts all':>10}")
+        for keyword in KEYWORDS:
+            like = (f"%{keyword}%", 0)
+            fts = (fts_phrase(keyword), 0)
+            like_page, _ = time_query(conn, SEARCH_ITEMS, like + (page,), repeat)
+            fts_page, _ = time_query(conn, SEARCH_ITEMS_FTS, fts + (page,), repeat)
+            ranked_page, _ = time_query(conn, SEARCH_ITEMS_RANKED, (fts_phrase(keyword), float("-inf"), 0, page), repeat)
+            like_all, _ = time_query(conn, SEARCH_ITEMS, like + (-1,), repeat)
+            fts_all, found = time_query(conn, SEARCH_ITEMS_FTS, fts + (-1,), repeat)
+            print(f"{keyword:<14}{found:>9}{like_page:>12.2f}{fts_page:>11.2f}{ranked_page:>13.2f}{like_all:>11.2f}{fts_all:>10.2f}")
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LIKE vs FTS5 search benchmark")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--page", type=int, default=101, help="rows fetched for a single /search page")
+    args = parser.parse_args()
+    for rows in args.rows:
+        run(rows, args.repeat, args.page)
+
+
+if __name__ == "__main__":
+    main()
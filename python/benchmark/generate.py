@@ -0,0 +1,140 @@
+# Builds a synthetic catalogue (database and images) to benchmark against:
+#
+#   python -m benchmark.generate --items 1000000 --out bench-data
+#
+# Point the app at it with DB_PATH=bench-data/mercari.sqlite3 IMAGES_DIR=bench-data/images.
+import io
+import random
+import shutil
+import sqlite3
+import pathlib
+import argparse
+import itertools
+import time
+from typing import Iterator, List, Optional
+
+from bulk import BulkIngester, Record
+from database import ConnectionPool
+from storage import ImageStore
+from migrations import migrate
+
+DEFAULT_IMAGE = pathlib.Path(__file__).parent.parent.resolve() / "images" / "default.jpg"
+
+EN_ADJECTIVES = [
+    "vintage", "black", "white", "navy", "leather", "wool", "denim", "cotton", "mini", "oversized",
+    "limited", "classic", "used", "new", "handmade", "waterproof", "wireless", "retro", "slim", "large",
+]
+EN_NOUNS = [
+    "jacket", "coat", "shirt", "sneakers", "boots", "bag", "backpack", "watch", "camera", "lens",
+    "headphones", "keyboard", "novel", "manga", "figure", "mug", "lamp", "chair", "guitar", "skirt",
+]
+JA_ADJECTIVES = ["古着", "黒", "白", "ヴィンテージ", "未使用", "美品", "限定", "ハンドメイド", "新品", "レトロ"]
+JA_NOUNS = [
+    "ジャケット", "コート", "シャツ", "スニーカー", "バッグ", "リュック", "腕時計", "カメラ", "レンズ",
+    "イヤホン", "キーボード", "小説", "漫画", "フィギュア", "マグカップ", "ランプ", "椅子", "ギター",
+]
+BRANDS = ["", "", "", "Mercari", "ACME", "Sakura", "Fuji", "Nordic", "ユニーク", "モダン"]
+CATEGORIES = [
+    "fashion", "shoes", "bags", "watches", "electronics", "cameras", "books", "manga", "toys", "kitchen",
+    "interior", "music", "sports", "outdoor", "beauty", "games", "ファッション", "家電", "本", "おもちゃ",
+    "インテリア", "スポーツ", "コスメ", "ゲーム", "ハンドメイド", "チケット", "自動車", "ペット", "食品", "その他",
+]
+
+
+def category_weights(count: int, skew: float) -> List[float]:
+    # Zipf-like: a few categories hold most of the catalogue, like real listings
+    return [1 / (rank ** skew) for rank in range(1, count + 1)]
+
+
+def make_name(rng: random.Random, japanese_ratio: float) -> str:
+    brand = rng.choice(BRANDS)
+    if rng.random() < japanese_ratio:
+        words = [rng.choice(JA_ADJECTIVES), rng.choice(JA_NOUNS)]
+        name = "".join(words) if rng.random() < 0.5 else " ".join(words)
+    else:
+        words = rng.sample(EN_ADJECTIVES, rng.randint(1, 2)) + [rng.choice(EN_NOUNS)]
+        name = " ".join(words)
+    return f"{brand} {name}" if brand else name
+
+
+def generate_items(
+    count: int, image_names: List[str], seed: int = 0, skew: float = 1.1, japanese_ratio: float = 0.5
+) -> Iterator[Record]:
+    rng = random.Random(seed)
+    cumulative = list(itertools.accumulate(category_weights(len(CATEGORIES), skew)))
+    for number in range(1, count + 1):
+        yield number, {
+            "name": make_name(rng, japanese_ratio),
+            "category": rng.choices(CATEGORIES, cum_weights=cumulative)[0],
+            "image_name": rng.choice(image_names) if image_names else "default.jpg",
+        }
+
+
+def generate_images(store: ImageStore, count: int, seed: int = 0, size: int = 320) -> List[str]:
+    from PIL import Image
+
+    rng = random.Random(seed)
+    names = []
+    for _ in range(count):
+        image = Image.new("RGB", (size, size), tuple(rng.randrange(256) for _ in range(3)))
+        # a few random pixels make every image (and so every hash) distinct
+        for _ in range(32):
+            image.putpixel((rng.randrange(size), rng.randrange(size)), tuple(rng.randrange(256) for _ in range(3)))
+        buffer = io.BytesIO()
+        image.save(buffer, "JPEG", quality=85)
+        buffer.seek(0)
+        names.append(store.save(buffer))
+    return names
+
+
+def build_catalogue(
+    out: pathlib.Path,
+    items: int,
+    images: int = 200,
+    seed: int = 0,
+    skew: float = 1.1,
+    japanese_ratio: float = 0.5,
+    force: bool = False,
+) -> pathlib.Path:
+    db_path = out / "mercari.sqlite3"
+    images_dir = out / "images"
+    if db_path.exists():
+        if not force:
+            raise FileExistsError(f"{db_path} already exists, pass --force to replace it")
+        for path in out.glob("mercari.sqlite3*"):
+            path.unlink()
+    images_dir.mkdir(parents=True, exist_ok=True)
+    shutil.copy(DEFAULT_IMAGE, images_dir / "default.jpg")
+
+    image_names = generate_images(ImageStore(images_dir), images, seed) if images else []
+    pool = ConnectionPool(db_path, size=1)
+    with pool.connection() as conn:
+        migrate(conn)
+        ingester = BulkIngester(conn)
+        ingester.ingest(generate_items(items, image_names, seed, skew, japanese_ratio))
+        conn.execute("ANALYZE")
+        conn.commit()
+    pool.close()
+    return db_path
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="generate a synthetic catalogue")
+    parser.add_argument("--items", type=int, default=10_000, help="number of items (10k to 10M)")
+    parser.add_argument("--images", type=int, default=200, help="distinct image files shared by the items")
+    parser.add_argument("--out", type=pathlib.Path, default=pathlib.Path("bench-data"))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--skew", type=float, default=1.1, help="Zipf exponent of the category distribution")
+    parser.add_argument("--japanese-ratio", type=float, default=0.5)
+    parser.add_argument("--force", action="store_true", help="replace an existing database")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    db_path = build_catalogue(args.out, args.items, args.images, args.seed, args.skew, args.japanese_ratio, args.force)
+    with sqlite3.connect(db_path) as conn:
+        count = conn.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+    print(f"wrote {count} items and {args.images} images to {args.out} in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
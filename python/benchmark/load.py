@@ -0,0 +1,234 @@
+# Load driver: a weighted mix of requests, or replayed traffic, against the app.
+#
+#   python -m benchmark.load --data bench-data --duration 30 --concurrency 32
+#   python -m benchmark.load --url http://127.0.0.1:9000 --data bench-data --mix items=50,search=50
+#   python -m benchmark.load --data bench-data --replay traffic.jsonl --output runs/today.json --compare runs/base.json
+#
+# Without --url the app is served in-process through httpx's ASGI transport; --data
+# points at a catalogue from benchmark.generate either way, and is where the request
+# mix draws its item ids and image names from. Replayed traffic is JSON lines of
+#   {"method": "GET", "path": "/search", "params": {"keyword": "jacket"}}
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import sqlite3
+import pathlib
+import argparse
+import itertools
+from collections import defaultdict
+from typing import Dict, Iterator, List, NamedTuple, Optional
+
+import httpx
+
+from benchmark import report
+from benchmark.generate import EN_NOUNS, JA_NOUNS, CATEGORIES
+
+DEFAULT_MIX = "items=30,item=30,search=20,image=15,post=5"
+
+
+class Call(NamedTuple):
+    endpoint: str
+    method: str
+    path: str
+    params: Optional[dict] = None
+    data: Optional[dict] = None
+    image: Optional[bytes] = None
+
+
+def endpoint_of(method: str, path: str) -> str:
+    # report label for a replayed request, matching the names used in --mix
+    parts = [part for part in path.split("/") if part]
+    if not parts:
+        return "root"
+    if parts[0] == "items":
+        if method == "POST":
+            return "bulk" if parts[-1] == "bulk" else "post"
+        return "item" if len(parts) > 1 else "items"
+    return parts[0]
+
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        if name not in ("items", "item", "search", "image", "post"):
+            raise ValueError(f"unknown endpoint in mix: {name}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+class Catalogue(NamedTuple):
+    max_id: int
+    image_names: List[str]
+    sample_image: bytes
+
+
+def load_catalogue(data: pathlib.Path) -> Catalogue:
+    with sqlite3.connect(data / "mercari.sqlite3") as conn:
+        max_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM items").fetchone()[0]
+        image_names = [row[0] for row in conn.execute("SELECT DISTINCT image_name FROM items LIMIT 1000")]
+    sample_image = (data / "images" / "default.jpg").read_bytes()
+    return Catalogue(max_id, image_names or ["default.jpg"], sample_image)
+
+
+def mixed_calls(mix: Dict[str, float], catalogue: Catalogue, seed: int = 0) -> Iterator[Call]:
+    rng = random.Random(seed)
+    names, weights = list(mix), list(mix.values())
+    keywords = EN_NOUNS + JA_NOUNS
+    while True:
+        endpoint = rng.choices(names, weights)[0]
+        if endpoint == "items":
+            yield Call(endpoint, "GET", "/items", {"limit": 100})
+        elif endpoint == "item":
+            yield Call(endpoint, "GET", f"/items/{rng.randint(1, max(catalogue.max_id, 1))}")
+        elif endpoint == "search":
+            yield Call(endpoint, "GET", "/search", {"keyword": rng.choice(keywords), "limit": 50})
+        elif endpoint == "image":
+            params = {"size": "thumb"} if rng.random() < 0.5 else None
+            yield Call(endpoint, "GET", f"/image/{rng.choice(catalogue.image_names)}", params)
+        else:
+            data = {"name": f"bench item {rng.randrange(10**9)}", "category": rng.choice(CATEGORIES)}
+            yield Call(endpoint, "POST", "/items", data=data, image=catalogue.sample_image)
+
+
+def replayed_calls(path: pathlib.Path, catalogue: Catalogue, loop: bool = True) -> Iterator[Call]:
+    records = [json.loads(line) for line in path.read_text().splitlines() if line.strip()]
+    if not records:
+        raise ValueError(f"{path} has no requests to replay")
+    for record in itertools.cycle(records) if loop else records:
+        method = record.get("method", "GET").upper()
+        image = catalogue.sample_image if method == "POST" and record["path"] == "/items" else None
+        yield Call(
+            endpoint_of(method, record["path"]),
+            method,
+            record["path"],
+            record.get("params"),
+            record.get("data"),
+            image,
+        )
+
+
+async def send(client: httpx.AsyncClient, call: Call) -> httpx.Response:
+    files = {"image": ("bench.jpg", call.image, "image/jpeg")} if call.image is not None else None
+    return await client.request(call.method, call.path, params=call.params, data=call.data, files=files)
+
+
+async def drive(
+    client: httpx.AsyncClient, calls: Iterator[Call], concurrency: int, duration: float, requests: Optional[int]
+):
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    errors: Dict[str, int] = defaultdict(int)
+    deadline = time.perf_counter() + duration
+    budget = itertools.count() if requests is None else iter(range(requests))
+
+    async def worker():
+        # the shared iterators hand out calls one at a time; there is no await between next() calls
+        for _ in budget:
+            if time.perf_counter() >= deadline:
+                return
+            call = next(calls, None)
+            if call is None:
+                return
+            start = time.perf_counter()
+            try:
+                response = await send(client, call)
+                await response.aread()
+                failed = response.status_code >= 500 or response.status_code == 429
+            except httpx.HTTPError:
+                failed = True
+            latencies[call.endpoint].append(time.perf_counter() - start)
+            if failed:
+                errors[call.endpoint] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, errors, time.perf_counter() - start
+
+
+def in_process_client(data: pathlib.Path) -> httpx.AsyncClient:
+    # main reads its paths at import time, so point it at the catalogue first
+    os.environ["DB_PATH"] = str(data / "mercari.sqlite3")
+    os.environ["IMAGES_DIR"] = str(data / "images")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    import main
+
+    main.setup_database()
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://benchmark")
+
+
+def shutdown_in_process():
+    main = sys.modules.get("main")
+    if main is not None:
+        main.item_writer.stop()
+        main.db_pool.close()
+        main.derivatives.shutdown()
+
+
+async def run(args) -> dict:
+    catalogue = load_catalogue(args.data)
+    if args.replay:
+        calls = replayed_calls(args.replay, catalogue, loop=args.requests is not None or args.duration > 0)
+    else:
+        calls = mixed_calls(parse_mix(args.mix), catalogue, args.seed)
+
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, limits=httpx.Limits(max_connections=args.concurrency))
+    else:
+        client = in_process_client(args.data)
+    try:
+        async with client:
+            if args.warmup:
+                await drive(client, calls, args.concurrency, float("inf"), args.warmup)
+            duration = args.duration if args.duration > 0 else float("inf")
+            latencies, errors, elapsed = await drive(client, calls, args.concurrency, duration, args.requests)
+    finally:
+        if not args.url:
+            shutdown_in_process()
+
+    config = {
+        "target": args.url or "in-process",
+        "data": str(args.data),
+        "items": catalogue.max_id,
+        "concurrency": args.concurrency,
+        "duration": args.duration,
+        "requests": args.requests,
+        "mix": None if args.replay else args.mix,
+        "replay": str(args.replay) if args.replay else None,
+        "seed": args.seed,
+    }
+    return report.build_report(latencies, errors, elapsed, config)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="HTTP load driver")
+    parser.add_argument("--data", type=pathlib.Path, default=pathlib.Path("bench-data"), help="benchmark.generate output")
+    parser.add_argument("--url", help="base URL of a running server; in-process when omitted")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="endpoint weights, e.g. items=30,item=30,search=20")
+    parser.add_argument("--replay", type=pathlib.Path, help="JSON lines of recorded requests to replay")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10, help="seconds; 0 runs until --requests are sent")
+    parser.add_argument("--requests", type=int, help="stop after this many requests")
+    parser.add_argument("--warmup", type=int, default=200, help="requests sent before measuring")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=pathlib.Path, help="save the report as JSON")
+    parser.add_argument("--compare", type=pathlib.Path, help="baseline report to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="allowed slowdown against the baseline")
+    args = parser.parse_args(argv)
+
+    result = asyncio.run(run(args))
+    print(report.format_table(result))
+    if args.output:
+        report.save(result, args.output)
+    if args.compare:
+        regressions = report.compare(result, report.load(args.compare), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# Summaries of a load run, saved as JSON so runs can be compared for regressions.
+import json
+import math
+import time
+import pathlib
+import platform
+from typing import Any, Dict, List, Optional
+
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    # nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(q / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize_endpoint(latencies: List[float], errors: int, elapsed: float) -> Dict[str, float]:
+    values = sorted(latencies)
+    summary = {
+        "requests": len(values),
+        "errors": errors,
+        "throughput_rps": len(values) / elapsed if elapsed else 0.0,
+        "mean_ms": sum(values) / len(values) * 1000 if values else 0.0,
+        "max_ms": values[-1] * 1000 if values else 0.0,
+    }
+    for q in PERCENTILES:
+        summary[f"p{q}_ms"] = percentile(values, q) * 1000
+    return summary
+
+
+def build_report(
+    latencies: Dict[str, List[float]], errors: Dict[str, int], elapsed: float, config: Dict[str, Any]
+) -> Dict[str, Any]:
+    endpoints = {
+        name: summarize_endpoint(latencies.get(name, []), errors.get(name, 0), elapsed)
+        for name in sorted(set(latencies) | set(errors))
+    }
+    everything = [value for values in latencies.values() for value in values]
+    return {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "config": config,
+        "elapsed_s": elapsed,
+        "total": summarize_endpoint(everything, sum(errors.values()), elapsed),
+        "endpoints": endpoints,
+    }
+
+
+def save(report: Dict[str, Any], path: pathlib.Path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+def load(path: pathlib.Path) -> Dict[str, Any]:
+    return json.loads(path.read_text())
+
+
+def format_table(report: Dict[str, Any]) -> str:
+    header = f"{'endpoint':<10}{'requests':>10}{'errors':>8}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+    lines = [header]
+    for name, row in list(report["endpoints"].items()) + [("total", report["total"])]:
+        lines.append(
+            f"{name:<10}{row['requests']:>10}{row['errors']:>8}{row['throughput_rps']:>10.1f}"
+            f"{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}{row['p99_ms']:>10.2f}"
+        )
+    return "\n".join(lines)
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], tolerance: float = 0.10) -> List[str]:
+    """List the endpoints that got slower or lost throughput by more than tolerance."""
+    regressions = []
+    for name, row in current["endpoints"].items():
+        before: Optional[Dict[str, float]] = baseline["endpoints"].get(name)
+        if before is None:
+            continue
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            if before[key] and row[key] > before[key] * (1 + tolerance):
+                regressions.append(f"{name} {key}: {before[key]:.2f} -> {row[key]:.2f}")
+        if before["throughput_rps"] and row["throughput_rps"] < before["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{name} throughput_rps: {before['throughput_rps']:.1f} -> {row['throughput_rps']:.1f}")
+    return regressions
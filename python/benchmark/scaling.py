@@ -0,0 +1,123 @@
+# Throughput against worker count: starts serve.py with each count in turn and
+# drives it with benchmark.load over real HTTP.
+#
+#   python -m benchmark.scaling --data bench-data --workers 1,2,4,8 --duration 20 --output runs/scaling.json
+#
+# Efficiency is the throughput per worker relative to one worker, so 1.0 is
+# linear scaling. Counts above the number of CPUs (and the load driver's own
+# CPU use) cannot scale, so run the driver on another machine for large counts.
+import os
+import sys
+import time
+import asyncio
+import pathlib
+import argparse
+import subprocess
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from benchmark import load, report
+
+SERVE = pathlib.Path(__file__).resolve().parent.parent / "serve.py"
+
+
+def wait_ready(url: str, process: subprocess.Popen, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"serve.py exited with {process.returncode} before becoming ready")
+        try:
+            # every worker has to be up, but they share the port; a run of successes is close enough
+            if all(httpx.get(f"{url}/readyz", timeout=1).status_code == 200 for _ in range(10)):
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} was not ready after {timeout}s")
+
+
+def measure(workers: int, args) -> Dict[str, Any]:
+    url = f"http://127.0.0.1:{args.port}"
+    env = dict(
+        os.environ,
+        DB_PATH=str(args.data.resolve() / "mercari.sqlite3"),
+        IMAGES_DIR=str(args.data.resolve() / "images"),
+    )
+    process = subprocess.Popen(
+        [sys.executable, str(SERVE), "--workers", str(workers), "--host", "127.0.0.1", "--port", str(args.port), "--log-level", "warning"],
+        cwd=SERVE.parent,
+        env=env,
+    )
+    try:
+        wait_ready(url, process, args.startup_timeout)
+        load_args = argparse.Namespace(
+            data=args.data,
+            url=url,
+            mix=args.mix,
+            replay=None,
+            concurrency=args.concurrency,
+            duration=args.duration,
+            requests=None,
+            warmup=args.warmup,
+            seed=args.seed,
+        )
+        return asyncio.run(load.run(load_args))
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def summarize(runs: Dict[int, Dict[str, Any]]) -> List[Dict[str, float]]:
+    base: Optional[float] = None
+    rows = []
+    for workers in sorted(runs):
+        total = runs[workers]["total"]
+        rps = total["throughput_rps"]
+        if base is None:
+            base = rps / workers
+        rows.append({
+            "workers": workers,
+            "throughput_rps": rps,
+            "p99_ms": total["p99_ms"],
+            "errors": total["errors"],
+            "efficiency": rps / workers / base if base else 0.0,
+        })
+    return rows
+
+
+def format_table(rows: List[Dict[str, float]]) -> str:
+    lines = [f"{'workers':>8}{'rps':>10}{'p99 ms':>10}{'errors':>8}{'efficiency':>12}"]
+    for row in rows:
+        lines.append(
+            f"{row['workers']:>8}{row['throughput_rps']:>10.1f}{row['p99_ms']:>10.2f}{row['errors']:>8}{row['efficiency']:>12.2f}"
+        )
+    return "\n".join(lines)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Measure throughput against the number of worker processes")
+    parser.add_argument("--data", type=pathlib.Path, default=pathlib.Path("bench-data"), help="benchmark.generate output")
+    parser.add_argument("--workers", default="1,2,4", help="comma-separated worker counts")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--mix", default="items=40,item=40,search=20", help="read-only by default, so runs see the same data")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--warmup", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--startup-timeout", type=float, default=60)
+    parser.add_argument("--output", type=pathlib.Path, help="save every run and the summary as JSON")
+    args = parser.parse_args(argv)
+
+    runs = {}
+    for workers in sorted({int(count) for count in args.workers.split(",")}):
+        runs[workers] = measure(workers, args)
+        print(f"{workers} workers: {runs[workers]['total']['throughput_rps']:.1f} rps", file=sys.stderr)
+    rows = summarize(runs)
+    print(format_table(rows))
+    if args.output:
+        report.save({"cpus": os.cpu_count(), "scaling": rows, "runs": {str(k): v for k, v in runs.items()}}, args.output)
+
+
+if __name__ == "__main__":
+    main()
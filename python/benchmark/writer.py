@@ -0,0 +1,80 @@
+# Concurrent single-item inserts: one commit per request vs the group-committing writer.
+#
+#   python -m benchmark.writer --threads 1 8 32
+import argparse
+import pathlib
+import sqlite3
+import tempfile
+import threading
+import time
+
+from database import ConnectionPool
+from writer import SingleWriter
+from main import Item, insert_item_by_db
+from migrations import migrate
+
+
+def fresh_pool(directory: str, name: str, size: int) -> ConnectionPool:
+    pool = ConnectionPool(pathlib.Path(directory) / name, size=size, timeout=60)
+    with pool.connection() as conn:
+        migrate(conn)
+    return pool
+
+
+def run_threads(threads: int, per_thread: int, insert) -> float:
+    errors = []
+
+    def worker(n):
+        for i in range(per_thread):
+            try:
+                insert(Item(name=f"item {n}-{i}", category=f"category {i % 10}", image_name="default.jpg"))
+            except Exception as e:
+                errors.append(e)
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    if errors:
+        print(f"  {len(errors)} inserts failed, e.g. {errors[0]}")
+    return (threads * per_thread - len(errors)) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="concurrent insert benchmark")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 4, 16, 32])
+    parser.add_argument("--per-thread", type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for threads in args.threads:
+            pool = fresh_pool(tmp, f"direct-{threads}.sqlite3", size=threads)
+
+            def direct(item):
+                with pool.connection() as conn:
+                    insert_item_by_db(item, conn)
+
+            direct_rate = run_threads(threads, args.per_thread, direct)
+            pool.close()
+
+            pool = fresh_pool(tmp, f"writer-{threads}.sqlite3", size=1)
+            writer = SingleWriter(pool)
+
+            def grouped(item):
+                writer.submit(lambda conn: insert_item_by_db(item, conn, commit=False)).result()
+
+            grouped_rate = run_threads(threads, args.per_thread, grouped)
+            stats = writer.stats()
+            writer.stop()
+            pool.close()
+            print(
+                f"{threads:>3} threads  per-request commit {direct_rate:>9,.0f}/s"
+                f"  group commit {grouped_rate:>9,.0f}/s (avg batch {stats['batch_size_avg']:.1f})"
+            )
+
+
+if __name__ == "__main__":
+    main()
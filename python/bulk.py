@@ -0,0 +1,190 @@
+# Bulk item ingestion shared by POST /items/bulk and the command line:
+#
+#   python bulk.py items.jsonl            # one {"name", "category", "image_name"} object per line
+#   python bulk.py items.json             # the legacy {"items": [...]} file from STEP 4-1
+import os
+import sys
+import json
+import logging
+import sqlite3
+import pathlib
+import argparse
+from typing import Any, BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from database import UPSERT_CATEGORY, INSERT_ITEM, SELECT_CATEGORIES, SELECT_CATEGORY_ID, INDEX_ITEMS_FTS_AFTER
+
+logger = logging.getLogger("uvicorn")
+
+# rows written per transaction
+BULK_CHUNK_SIZE = int(os.environ.get("BULK_CHUNK_SIZE", "20000"))
+# keep the response bounded when a whole file is malformed
+MAX_REPORTED_ERRORS = int(os.environ.get("BULK_MAX_REPORTED_ERRORS", "1000"))
+
+
+class RowError(ValueError):
+    pass
+
+
+# (row number, parsed record or the error that prevented parsing it)
+Record = Tuple[int, Any]
+
+
+def parse_jsonl(lines: Iterable[bytes], start: int = 1) -> Iterator[Record]:
+    for number, line in enumerate(lines, start=start):
+        if not line.strip():
+            continue
+        try:
+            yield number, json.loads(line)
+        except ValueError as e:
+            yield number, RowError(f"invalid JSON: {e}")
+
+
+def parse_legacy_json(src: BinaryIO) -> Iterator[Record]:
+    try:
+        data = json.load(src)
+    except ValueError as e:
+        yield 0, RowError(f"invalid JSON: {e}")
+        return
+    if not isinstance(data, dict) or not isinstance(data.get("items"), list):
+        yield 0, RowError('expected an object with an "items" list')
+        return
+    yield from enumerate(data["items"], start=1)
+
+
+def parse_file(src: BinaryIO, filename: Optional[str]) -> Iterator[Record]:
+    # .json files use the legacy items.json layout, anything else is JSONL
+    if filename and filename.endswith(".json"):
+        return parse_legacy_json(src)
+    return parse_jsonl(src)
+
+
+def validate(record: Any) -> Tuple[str, str, Optional[str]]:
+    if not isinstance(record, dict):
+        raise RowError("expected a JSON object")
+    name, category, image_name = record.get("name"), record.get("category"), record.get("image_name")
+    if not isinstance(name, str) or not name:
+        raise RowError("name is required")
+    if not isinstance(category, str) or not category:
+        raise RowError("category is required")
+    if image_name is not None and not isinstance(image_name, str):
+        raise RowError("image_name must be a string")
+    return name, category, image_name
+
+
+class BulkIngester:
+    """Inserts items in chunked transactions, resolving categories from an in-memory map."""
+
+    def __init__(
+        self,
+        conn: sqlite3.Connection,
+        chunk_size: int = BULK_CHUNK_SIZE,
+        on_commit: Optional[Callable[[], None]] = None,
+    ):
+        self.conn = conn
+        self.chunk_size = chunk_size
+        # called after every committed chunk
+        self.on_commit = on_commit
+        self.categories: Dict[str, int] = {name: id for id, name in conn.execute(SELECT_CATEGORIES)}
+        # databases whose insert trigger predates items_fts_paused get indexed row by row
+        trigger = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = 'items_fts_insert'").fetchone()
+        self.batch_index = trigger is not None and "items_fts_paused" in trigger[0]
+        self.inserted = 0
+        self.failed = 0
+        self.errors: List[Dict[str, Any]] = []
+
+    def _error(self, row: int, error: Exception):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"row": row, "error": str(error)})
+
+    def ingest(self, records: Iterable[Record]):
+        rows = []
+        for number, record in records:
+            if isinstance(record, Exception):
+                self._error(number, record)
+                continue
+            try:
+                rows.append((number, *validate(record)))
+            except RowError as e:
+                self._error(number, e)
+                continue
+            if len(rows) >= self.chunk_size:
+                self._write(rows)
+                rows = []
+        if rows:
+            self._write(rows)
+
+    def _write(self, rows: List[Tuple[int, str, str, Optional[str]]]):
+        new_categories = []
+        try:
+            with self.conn:  # one transaction (and one fsync) per chunk
+                if self.batch_index:
+                    # only visible inside this transaction, so other writers keep their trigger
+                    self.conn.execute("INSERT INTO items_fts_paused (paused) VALUES (1)")
+                    last_id = self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM items").fetchone()[0]
+                params = []
+                for _, name, category, image_name in rows:
+                    category_id = self.categories.get(category)
+                    if category_id is None:
+                        # upsert: the single writer may have created it since the map was loaded
+                        self.conn.execute(UPSERT_CATEGORY, (category,))
+                        category_id = self.conn.execute(SELECT_CATEGORY_ID, (category,)).fetchone()[0]
+                        self.categories[category] = category_id
+                        new_categories.append(category)
+                    params.append((name, category_id, image_name))
+                self.conn.executemany(INSERT_ITEM, params)
+                if self.batch_index:
+                    self.conn.execute(INDEX_ITEMS_FTS_AFTER, (last_id,))
+                    self.conn.execute("DELETE FROM items_fts_paused")
+        except sqlite3.Error as e:
+            # the rollback also undid any categories created for this chunk
+            for category in new_categories:
+                self.categories.pop(category, None)
+            if len(rows) == 1:
+                self._error(rows[0][0], e)
+                return
+            # retry row by row so the error is reported against the rows that caused it
+            for row in rows:
+                self._write([row])
+            return
+        self.inserted += len(rows)
+        # outside the try: the chunk is committed, so a failing callback must not retry it
+        if self.on_commit is not None:
+            try:
+                self.on_commit()
+            except Exception as e:
+                logger.error(f"Commit callback failed: {e}")
+
+    def result(self) -> Dict[str, Any]:
+        return {"inserted": self.inserted, "failed": self.failed, "errors": self.errors}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk load items into the database")
+    parser.add_argument("files", nargs="+", type=pathlib.Path, help="JSONL files, or legacy items.json files")
+    parser.add_argument("--db", type=pathlib.Path, default=None, help="database file (defaults to mercari.sqlite3)")
+    parser.add_argument("--chunk-size", type=int, default=BULK_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    import main as app_module
+    from database import ConnectionPool
+
+    path = args.db or app_module.db
+    app_module.setup_database(path)
+    pool = ConnectionPool(path, size=1)
+    with pool.connection() as conn:
+        ingester = BulkIngester(conn, args.chunk_size)
+        for file in args.files:
+            with open(file, "rb") as src:
+                ingester.ingest(parse_file(src, file.name))
+    pool.close()
+
+    result = ingester.result()
+    for error in result["errors"]:
+        print(f"row {error['row']}: {error['error']}", file=sys.stderr)
+    print(f"inserted {result['inserted']} items, {result['failed']} failed")
+    return 1 if result["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
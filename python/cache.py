@@ -0,0 +1,145 @@
+import os
+import mmap
+import time
+import struct
+import pathlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+try:
+    import fcntl
+except ImportError:  # not on Windows; SharedCatalogueVersion is unavailable there
+    fcntl = None
+
+
+class LRUCache:
+    """A thread-safe LRU cache bounded by the total size of its values in bytes.
+
+    With a ttl, entries also expire that many seconds after they were stored.
+    """
+
+    def __init__(self, max_bytes: int, max_item_bytes: Optional[int] = None, ttl: Optional[float] = None):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_bytes if max_item_bytes is None else max_item_bytes
+        self.ttl = ttl
+        # key -> (value, size, expires at)
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[2] is not None and entry[2] <= time.monotonic():
+                del self._entries[key]
+                self._size -= entry[1]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any, size: Optional[int] = None) -> bool:
+        # size defaults to len(value), which is right for bytes
+        size = len(value) if size is None else size
+        if size > self.max_item_bytes:
+            return False
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= old[1]
+            self._entries[key] = (value, size, expires)
+            self._size += size
+            while self._size > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+                self.evictions += 1
+        return True
+
+    def discard(self, key: Hashable):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= old[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+class CatalogueVersion:
+    """A counter bumped after every committed catalogue write.
+
+    Cached responses are keyed on the version they were read at, so a bump
+    makes every older entry unreachable at once.
+    """
+
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    @property
+    def value(self) -> int:
+        return self._value
+
+    def bump(self) -> int:
+        with self._lock:
+            self._value += 1
+            return self._value
+
+
+class SharedCatalogueVersion:
+    """A CatalogueVersion shared by every worker process through an 8-byte memory-mapped file.
+
+    Reading it is a plain memory load. Bumps hold an exclusive lock on the file
+    so increments from different processes are never lost.
+    """
+
+    def __init__(self, path: pathlib.Path):
+        if fcntl is None:
+            raise RuntimeError("A shared catalogue version needs fcntl, which this platform lacks")
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self._fd).st_size < 8:
+            os.ftruncate(self._fd, 8)
+        self._map = mmap.mmap(self._fd, 8)
+        self._lock = threading.Lock()
+
+    @property
+    def value(self) -> int:
+        return struct.unpack_from("<Q", self._map)[0]
+
+    def bump(self) -> int:
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                value = self.value + 1
+                struct.pack_into("<Q", self._map, 0, value)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return value
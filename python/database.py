@@ -0,0 +1,338 @@
+import os
+import time
+import queue
+import logging
+import sqlite3
+import pathlib
+import threading
+from contextlib import contextmanager
+from typing import Dict, Optional, Union
+
+from metrics import sql_fetch_seconds, sql_query_seconds, sql_rows, sql_slow_queries
+
+logger = logging.getLogger("uvicorn")
+
+# Connections per process and how long a request waits for one before PoolTimeout
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "4"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "5.0"))
+DB_MMAP_SIZE = int(os.environ.get("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+# negative values are KiB, so this is a 64 MiB page cache per connection
+DB_CACHE_SIZE = int(os.environ.get("DB_CACHE_SIZE", str(-64 * 1024)))
+# sqlite3 keeps compiled statements per connection keyed by their SQL text,
+# so every fixed query below is prepared once per pooled connection
+DB_STATEMENT_CACHE_SIZE = int(os.environ.get("DB_STATEMENT_CACHE_SIZE", "128"))
+# statements (or single fetches) slower than this are logged
+DB_SLOW_QUERY_SECONDS = float(os.environ.get("DB_SLOW_QUERY_SECONDS", "0.1"))
+
+
+# The fixed queries used by the handlers. Keeping the text in one place means
+# the same string hits the per-connection statement cache every time.
+# Keyset pagination on items.id; LIMIT -1 means no limit for full exports
+SELECT_ITEMS = """
+SELECT items.id, items.name, categories.name AS category, items.image_name
+FROM items
+JOIN categories ON items.category_id = categories.id
+WHERE items.id > ?
+ORDER BY items.id
+LIMIT ?
+"""
+
+SELECT_ITEM_BY_ID = """
+SELECT items.id, items.name, categories.name AS category, items.image_name
+FROM items
+JOIN categories ON items.category_id = categories.id
+WHERE items.id = ?
+"""
+
+# LIKE scan, only used for keywords too short for the trigram index; it matches
+# the same columns as items_fts so results do not depend on the keyword's length
+SEARCH_ITEMS = """
+SELECT items.id, items.name, categories.name AS category, items.image_name
+FROM items
+JOIN categories ON items.category_id = categories.id
+WHERE (items.name LIKE ? OR categories.name LIKE ?) AND items.id > ?
+ORDER BY items.id
+LIMIT ?
+"""
+
+# FTS5 match in items.id order, same keyset contract as SELECT_ITEMS
+SEARCH_ITEMS_FTS = """
+SELECT items.id, items.name, categories.name AS category, items.image_name
+FROM items_fts
+JOIN items ON items.id = items_fts.rowid
+JOIN categories ON items.category_id = categories.id
+WHERE items_fts MATCH ? AND items_fts.rowid > ?
+ORDER BY items_fts.rowid
+LIMIT ?
+"""
+
+# FTS5 match ranked by bm25 (lower is better), keyset on (score, items.id)
+SEARCH_ITEMS_RANKED = """
+SELECT items.id, items.name, categories.name AS category, items.image_name, hits.score
+FROM (
+    SELECT rowid, bm25(items_fts) AS score FROM items_fts WHERE items_fts MATCH ?
+) AS hits
+JOIN items ON items.id = hits.rowid
+JOIN categories ON items.category_id = categories.id
+WHERE (hits.score, items.id) > (?, ?)
+ORDER BY hits.score, items.id
+LIMIT ?
+"""
+
+BACKFILL_ITEMS_FTS = """
+INSERT INTO items_fts (rowid, name, category)
+SELECT items.id, items.name, categories.name
+FROM items
+JOIN categories ON items.category_id = categories.id
+"""
+
+# used by bulk loads to index the rows they just inserted
+INDEX_ITEMS_FTS_AFTER = BACKFILL_ITEMS_FTS + "WHERE items.id > ?\n"
+
+SELECT_CATEGORY_ID = "SELECT id FROM categories WHERE name = ?"
+
+SELECT_CATEGORIES = "SELECT id, name FROM categories"
+
+# categories.name is UNIQUE, so a name another connection created first is not an error
+UPSERT_CATEGORY = "INSERT INTO categories (name) VALUES (?) ON CONFLICT (name) DO NOTHING"
+
+INSERT_ITEM = """
+INSERT INTO items (name, category_id, image_name) VALUES (?, ?, ?)
+"""
+
+# item counts per name and per category for the /suggest index; both group on an index
+SUGGEST_ITEM_NAMES = "SELECT name, COUNT(*) FROM items GROUP BY name"
+
+SUGGEST_CATEGORY_NAMES = """
+SELECT categories.name, COUNT(*)
+FROM items
+JOIN categories ON items.category_id = categories.id
+GROUP BY items.category_id
+"""
+
+
+# reference counts of stored images, formatted with one ? per name
+COUNT_IMAGE_REFERENCES = """
+SELECT image_name, COUNT(*) FROM items WHERE image_name IN ({}) GROUP BY image_name
+"""
+
+# metric labels for the fixed queries; anything else is labelled by its first keyword
+QUERY_LABELS = {
+    SELECT_ITEMS: "select_items",
+    SELECT_ITEM_BY_ID: "select_item_by_id",
+    SEARCH_ITEMS: "search_items_like",
+    SEARCH_ITEMS_FTS: "search_items_fts",
+    SEARCH_ITEMS_RANKED: "search_items_ranked",
+    BACKFILL_ITEMS_FTS: "backfill_items_fts",
+    INDEX_ITEMS_FTS_AFTER: "index_items_fts",
+    SELECT_CATEGORY_ID: "select_category_id",
+    SELECT_CATEGORIES: "select_categories",
+    UPSERT_CATEGORY: "upsert_category",
+    INSERT_ITEM: "insert_item",
+    SUGGEST_ITEM_NAMES: "suggest_item_names",
+    SUGGEST_CATEGORY_NAMES: "suggest_category_names",
+}
+
+# statements whose cost grows with the size of a bulk load; like executemany they are
+# timed but never reported as slow queries, since every large chunk would be
+BULK_QUERIES = frozenset({BACKFILL_ITEMS_FTS, INDEX_ITEMS_FTS_AFTER})
+
+
+def query_label(sql: str) -> str:
+    label = QUERY_LABELS.get(sql)
+    if label is None:
+        words = sql.split(None, 1)
+        label = words[0].lower() if words else "empty"
+    return label
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Records statement time, fetch time and fetched row counts per query label."""
+
+    _label = "unknown"
+    _sql = ""
+    _bulk = False
+
+    def _observe(self, elapsed: float):
+        sql_query_seconds.observe(elapsed, query=self._label)
+        if elapsed >= DB_SLOW_QUERY_SECONDS and not self._bulk:
+            self._slow("execute", elapsed)
+
+    def _fetched(self, elapsed: float, rows: int):
+        sql_fetch_seconds.inc(elapsed, query=self._label)
+        sql_rows.inc(rows, query=self._label)
+        if elapsed >= DB_SLOW_QUERY_SECONDS:
+            self._slow("fetch", elapsed)
+
+    def _slow(self, phase: str, elapsed: float):
+        sql_slow_queries.inc(query=self._label)
+        logger.warning("Slow query %s (%s took %.3fs): %s", self._label, phase, elapsed, " ".join(self._sql.split()))
+
+    def execute(self, sql, parameters=()):
+        self._label, self._sql, self._bulk = query_label(sql), sql, sql in BULK_QUERIES
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._observe(time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        self._label, self._sql, self._bulk = query_label(sql), sql, True
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._observe(time.perf_counter() - start)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(time.perf_counter() - start, 0 if row is None else 1)
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        start = time.perf_counter()
+        rows = super().fetchmany(*args, **kwargs)
+        self._fetched(time.perf_counter() - start, len(rows))
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(time.perf_counter() - start, len(rows))
+        return rows
+
+
+class TimedConnection(sqlite3.Connection):
+    # Connection.execute does not go through cursor(), so both are routed to TimedCursor
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+class PoolTimeout(RuntimeError):
+    pass
+
+
+class ConnectionPool:
+    """A fixed-size pool of SQLite connections opened lazily and reused across requests."""
+
+    def __init__(
+        self,
+        path: Union[str, pathlib.Path],
+        size: int = DB_POOL_SIZE,
+        timeout: float = DB_POOL_TIMEOUT,
+        pragmas: Optional[Dict[str, Union[str, int]]] = None,
+    ):
+        if size < 1:
+            raise ValueError(f"pool size must be at least 1, got {size}")
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.pragmas = {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "mmap_size": DB_MMAP_SIZE,
+            "cache_size": DB_CACHE_SIZE,
+        }
+        if pragmas:
+            self.pragmas.update(pragmas)
+
+        # LIFO so the most recently used (warmest) connection is handed out first
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._opened = 0
+        self._checkouts = 0
+        self._waited = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def connect(self) -> sqlite3.Connection:
+        # a connection configured like the pooled ones but not counted against the pool,
+        # e.g. the writer's dedicated connection
+        conn = sqlite3.connect(
+            self.path,
+            check_same_thread=False,
+            cached_statements=DB_STATEMENT_CACHE_SIZE,
+            factory=TimedConnection,
+        )
+        conn.row_factory = sqlite3.Row  # Return rows as dictionaries
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        start = time.perf_counter()
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_open = self._opened < self.size
+                if can_open:
+                    self._opened += 1
+            if can_open:
+                try:
+                    conn = self.connect()
+                except Exception:
+                    with self._lock:
+                        self._opened -= 1
+                    raise
+            else:
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    self._record_wait(time.perf_counter() - start)
+                    raise PoolTimeout(f"no database connection available after {self.timeout}s")
+        self._record_wait(time.perf_counter() - start)
+        return conn
+
+    def release(self, conn: sqlite3.Connection):
+        # never hand out a connection with a half-finished transaction
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        # closes idle connections; checked-out ones are closed on a later close()
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._opened -= 1
+
+    def _record_wait(self, waited: float):
+        with self._lock:
+            self._checkouts += 1
+            self._wait_total += waited
+            if waited > self._wait_max:
+                self._wait_max = waited
+            if waited > 0.001:
+                self._waited += 1
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "size": self.size,
+                "open": self._opened,
+                "idle": self._idle.qsize(),
+                "checkouts": self._checkouts,
+                "waited_checkouts": self._waited,
+                "wait_seconds_total": self._wait_total,
+                "wait_seconds_max": self._wait_max,
+            }
@@ -0,0 +1,51 @@
+-- Baseline schema, formerly db/items.sql. Everything is IF NOT EXISTS so databases
+-- created from that file before migrations existed adopt it unchanged.
+CREATE TABLE IF NOT EXISTS categories (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS items (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    category_id INTEGER NOT NULL,
+    image_name TEXT,
+    FOREIGN KEY (category_id) REFERENCES categories(id)
+);
+
+-- Full-text index over item and category names for /search. The trigram
+-- tokenizer matches any substring of 3+ characters, including Japanese text.
+CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5(
+    name,
+    category,
+    tokenize = 'trigram'
+);
+-- Bulk loads add a row here inside their own transaction and index each chunk
+-- with one INSERT ... SELECT, which is much faster than a trigger per row.
+CREATE TABLE IF NOT EXISTS items_fts_paused (
+    paused INTEGER
+);
+CREATE TRIGGER IF NOT EXISTS items_fts_insert AFTER INSERT ON items
+WHEN NOT EXISTS (SELECT 1 FROM items_fts_paused) BEGIN
+    INSERT INTO items_fts (rowid, name, category)
+    SELECT new.id, new.name, categories.name FROM categories WHERE categories.id = new.category_id;
+END;
+CREATE TRIGGER IF NOT EXISTS items_fts_delete AFTER DELETE ON items BEGIN
+    DELETE FROM items_fts WHERE rowid = old.id;
+END;
+CREATE TRIGGER IF NOT EXISTS items_fts_update AFTER UPDATE ON items BEGIN
+    DELETE FROM items_fts WHERE rowid = old.id;
+    INSERT INTO items_fts (rowid, name, category)
+    SELECT new.id, new.name, categories.name FROM categories WHERE categories.id = new.category_id;
+END;
+CREATE TRIGGER IF NOT EXISTS items_fts_category_update AFTER UPDATE OF name ON categories BEGIN
+    UPDATE items_fts SET category = new.name
+    WHERE rowid IN (SELECT id FROM items WHERE category_id = new.id);
+END;
+-- Index the items of databases created before items_fts existed. This runs in the
+-- same transaction as the version bump, so an interrupted startup redoes it; rows
+-- an existing index already has are skipped.
+INSERT INTO items_fts (rowid, name, category)
+SELECT items.id, items.name, categories.name
+FROM items
+JOIN categories ON items.category_id = categories.id
+WHERE items.id NOT IN (SELECT rowid FROM items_fts);
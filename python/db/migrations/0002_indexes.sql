@@ -0,0 +1,19 @@
+-- Indexes for the category lookup on insert and for every items/categories JOIN.
+--
+-- Category names become unique so inserts can upsert them. Older databases
+-- could hold the same name twice, so first point items at the lowest id for
+-- each name and drop the duplicates.
+UPDATE items SET category_id = (
+    SELECT MIN(same.id) FROM categories
+    JOIN categories AS same ON same.name = categories.name
+    WHERE categories.id = items.category_id
+)
+WHERE category_id NOT IN (SELECT MIN(id) FROM categories GROUP BY name);
+DELETE FROM categories WHERE id NOT IN (SELECT MIN(id) FROM categories GROUP BY name);
+
+CREATE UNIQUE INDEX IF NOT EXISTS categories_name ON categories (name);
+CREATE INDEX IF NOT EXISTS items_category_id ON items (category_id);
+CREATE INDEX IF NOT EXISTS items_name ON items (name);
+
+-- planner statistics for the new indexes
+ANALYZE;
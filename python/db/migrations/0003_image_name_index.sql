@@ -0,0 +1,2 @@
+-- The image garbage collector counts the items referencing each stored file.
+CREATE INDEX IF NOT EXISTS items_image_name ON items (image_name);
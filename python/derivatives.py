@@ -0,0 +1,160 @@
+import os
+import time
+import logging
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Literal, Optional, Tuple
+
+from storage import FILE_MODE, ImageStore
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # resizing is disabled and originals are served instead
+    Image = None
+
+logger = logging.getLogger("uvicorn")
+
+VariantSize = Literal["thumb", "detail"]
+
+# longest edge in pixels for each variant, overridable from the environment
+VARIANT_SIZES: Dict[str, int] = {
+    "thumb": int(os.environ.get("THUMB_SIZE", "240")),
+    "detail": int(os.environ.get("DETAIL_SIZE", "800")),
+}
+DERIVATIVE_WORKERS = int(os.environ.get("DERIVATIVE_WORKERS", "2"))
+VARIANT_QUALITY = int(os.environ.get("VARIANT_QUALITY", "85"))
+# images that failed to render (e.g. uploads that are not JPEGs) are not retried for this long
+DERIVATIVE_FAILURE_TTL = float(os.environ.get("DERIVATIVE_FAILURE_TTL", "600"))
+
+
+# <sha256>.jpg -> <sha256>_thumb.jpg, stored in the same shard as the original
+def variant_name(image_name: str, size: str) -> str:
+    return f"{image_name[:-4]}_{size}.jpg"
+
+
+def render_variant(source: str, target: str, max_edge: int) -> str:
+    # runs in a worker process, so it only takes and returns plain strings
+    with Image.open(source) as original:
+        image = ImageOps.exif_transpose(original)
+        image.thumbnail((max_edge, max_edge))
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        # the original may still be in the flat layout, before its shard exists
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target), prefix=".variant-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as out:
+                os.fchmod(out.fileno(), FILE_MODE)
+                image.save(out, "JPEG", quality=VARIANT_QUALITY, optimize=True, progressive=True)
+            os.replace(tmp_path, target)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+    return target
+
+
+class DerivativeGenerator:
+    """Renders resized variants of uploaded images in a process pool.
+
+    Concurrent requests for the same variant share one job, and nothing here
+    blocks the caller: every method returns as soon as the job is queued.
+    """
+
+    def __init__(
+        self,
+        store: ImageStore,
+        sizes: Dict[str, int] = VARIANT_SIZES,
+        workers: int = DERIVATIVE_WORKERS,
+        failure_ttl: float = DERIVATIVE_FAILURE_TTL,
+    ):
+        self.store = store
+        self.sizes = sizes
+        self.workers = workers
+        self.failure_ttl = failure_ttl
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._pending: Dict[Tuple[str, str], Future] = {}
+        # image name -> (when to try again, why it failed)
+        self._failed: Dict[str, Tuple[float, BaseException]] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return Image is not None
+
+    def _pool(self) -> ProcessPoolExecutor:
+        # workers start from a clean interpreter: forking the app would copy its caches,
+        # and forking a process that already runs threads can deadlock the child
+        if self._executor is None:
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context(method))
+        return self._executor
+
+    def _discard(self, executor: ProcessPoolExecutor):
+        # a worker died (e.g. OOM-killed) and broke the pool; the next job starts a fresh one
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    # ensure() and submit() stat files and may start the process pool, so call them from a thread
+    def ensure(self, image_name: str, size: str) -> Future:
+        key = (image_name, size)
+        with self._lock:
+            future = self._pending.get(key)
+            if future is not None:
+                return future
+            failed = self._failed.get(image_name)
+            if failed is not None:
+                if failed[0] > time.monotonic():
+                    future = Future()
+                    future.set_exception(failed[1])
+                    return future
+                del self._failed[image_name]
+            source = self.store.locate(image_name) or self.store.path(image_name)
+            target = self.store.path(variant_name(image_name, size))
+            args = (render_variant, str(source), str(target), self.sizes[size])
+            executor, broken = self._pool(), None
+            try:
+                future = executor.submit(*args)
+            except BrokenProcessPool:
+                # broken since the last job finished; retry once on a fresh pool
+                broken, self._executor = executor, None
+                executor = self._pool()
+                future = executor.submit(*args)
+            self._pending[key] = future
+        if broken is not None:
+            broken.shutdown(wait=False, cancel_futures=True)
+        future.add_done_callback(lambda done: self._finish(key, done, executor))
+        return future
+
+    def _finish(self, key: Tuple[str, str], future: Future, executor: ProcessPoolExecutor):
+        error = future.exception() if not future.cancelled() else None
+        if isinstance(error, BrokenProcessPool):
+            # not the image's fault, so it is not remembered as a failed render
+            self._discard(executor)
+        with self._lock:
+            self._pending.pop(key, None)
+            if error is not None and not isinstance(error, BrokenProcessPool):
+                now = time.monotonic()
+                if len(self._failed) >= 1024:
+                    self._failed = {name: entry for name, entry in self._failed.items() if entry[0] > now}
+                self._failed[key[0]] = (now + self.failure_ttl, error)
+        if error is not None:
+            logger.error(f"Failed to render {key[1]} variant of {key[0]}: {error}")
+
+    def submit(self, image_name: str):
+        # queue every missing variant of a freshly stored image
+        if not self.enabled:
+            return
+        for size in self.sizes:
+            if self.store.locate(variant_name(image_name, size)) is None:
+                self.ensure(image_name, size)
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,77 @@
+import re
+from typing import Dict, Optional, Tuple
+
+from fastapi import Request
+from fastapi.responses import Response
+
+# uploaded images are named after the SHA-256 of their content, so they never
+# change; neither do their resized variants (<sha256>_<size>.jpg)
+CONTENT_ADDRESSED = re.compile(r"^[0-9a-f]{64}(_[a-z]+)?\.jpg$")
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+# used for anything whose content may change under the same URL, like the placeholder
+REVALIDATE = "no-cache"
+
+
+def cache_headers(etag: str, cache_control: str) -> Dict[str, str]:
+    return {"ETag": etag, "Cache-Control": cache_control, "Accept-Ranges": "bytes"}
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    # If-None-Match uses the weak comparison, so W/ prefixes are ignored
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return any(tag.removeprefix("W/") == etag for tag in candidates)
+
+
+def parse_byte_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Parse a single `bytes=` range into inclusive (start, end) offsets.
+
+    Returns None for headers we do not handle (other units, multiple ranges),
+    in which case the whole body is served. Raises ValueError when the range
+    cannot be satisfied.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, sep, last = spec.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+        else:
+            # suffix range: the last N bytes
+            start = max(size - int(last), 0)
+            end = size - 1
+    except ValueError:
+        return None
+    if start < 0 or start > end:
+        return None
+    if start >= size:
+        raise ValueError(f"range {header} not satisfiable for {size} bytes")
+    return start, min(end, size - 1)
+
+
+def bytes_response(request: Request, data: bytes, headers: Dict[str, str], media_type: str) -> Response:
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    # If-Range needs a strong match with the current ETag, otherwise serve it all
+    if range_header and (if_range is None or if_range == headers.get("ETag")):
+        try:
+            byte_range = parse_byte_range(range_header, len(data))
+        except ValueError:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{len(data)}"})
+        if byte_range is not None:
+            start, end = byte_range
+            return Response(
+                data[start:end + 1],
+                status_code=206,
+                media_type=media_type,
+                headers={**headers, "Content-Range": f"bytes {start}-{end}/{len(data)}"},
+            )
+    return Response(data, media_type=media_type, headers=headers)
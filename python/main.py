@@ -1,34 +1,172 @@
 import os
 import logging
 import pathlib
-from fastapi import FastAPI, Form, HTTPException, Depends, File, UploadFile
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, Form, HTTPException, Depends, File, UploadFile, Query, Request
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.concurrency import run_in_threadpool
 import sqlite3
 from pydantic import BaseModel, Field
 from contextlib import asynccontextmanager
 import json
+import asyncio
 import hashlib
-from typing import Dict, List, Optional
+import threading
+from typing import Dict, List, NamedTuple, Optional
+from database import (
+    ConnectionPool,
+    PoolTimeout,
+    SELECT_ITEMS,
+    SELECT_ITEM_BY_ID,
+    SELECT_CATEGORY_ID,
+    UPSERT_CATEGORY,
+    INSERT_ITEM,
+)
+from pagination import (
+    DEFAULT_PAGE_SIZE,
+    MAX_PAGE_SIZE,
+    StreamFormat,
+    build_page,
+    decode_cursor,
+    dumps,
+    stream_query,
+)
+from migrations import migrate
+from suggest import SUGGEST_DEFAULT_LIMIT, SUGGEST_MAX_LIMIT, PrefixIndex
+from search import SearchSort, plan_search
+from storage import MAX_UPLOAD_SIZE, ImageStore, UploadTooLarge
+from maintenance import ImageMaintenance
+from middleware import BodySizeLimitMiddleware, MetricsMiddleware
+from metrics import WorkerSnapshots, http_request_seconds, registry, render_gauges, render_worker_gauges
+from writer import SingleWriter
+from bulk import BULK_CHUNK_SIZE, BulkIngester, parse_file, parse_jsonl
+from cache import CatalogueVersion, LRUCache, SharedCatalogueVersion
+from compression import COMPRESS_MIN_SIZE, GZIP_LEVEL, compress, negotiate
+from derivatives import DerivativeGenerator, VariantSize, variant_name
+from http_cache import CONTENT_ADDRESSED, IMMUTABLE, REVALIDATE, bytes_response, cache_headers, etag_matches
+
+
+# Define the path to the images & sqlite3 database (IMAGES_DIR and DB_PATH point
+# the app at another catalogue, e.g. one built by benchmark.generate)
+images = pathlib.Path(os.environ.get("IMAGES_DIR", pathlib.Path(__file__).parent.resolve() / "images"))
+items_file = pathlib.Path(__file__).parent.resolve() / "items.json"
+db = pathlib.Path(os.environ.get("DB_PATH", pathlib.Path(__file__).parent.resolve() / "mercari.sqlite3"))
 
 
-# Define the path to the images & sqlite3 database
-images = pathlib.Path(__file__).parent.resolve() / "images"
-items_file = pathlib.Path(__file__).parent.resolve() / "items.json"
-db = pathlib.Path(__file__).parent.resolve() / "mercari.sqlite3"
-SQL_File = pathlib.Path(__file__).parent.resolve() / "db" / "items.sql"
+# Connections are opened lazily and reused across requests
+db_pool = ConnectionPool(db)
+
+
+def get_db_pool() -> ConnectionPool:
+    return db_pool
+
+
+def get_db(pool: ConnectionPool = Depends(get_db_pool)):
+    with pool.connection() as conn:
+        yield conn
+
+
+# Read responses are cached as encoded JSON, keyed on the catalogue version
+# they were read at. Every committed write bumps the version.
+RESPONSE_CACHE_BYTES = int(os.environ.get("RESPONSE_CACHE_BYTES", str(32 * 1024 * 1024)))
+RESPONSE_CACHE_MAX_ITEM_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_ITEM_BYTES", str(1024 * 1024)))
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", "60"))
+response_cache = LRUCache(RESPONSE_CACHE_BYTES, RESPONSE_CACHE_MAX_ITEM_BYTES, ttl=RESPONSE_CACHE_TTL)
+# with several worker processes (see serve.py) the version lives in a file they all
+# map, so a write in one worker also retires the responses the others cached
+if os.environ.get("SHARED_CATALOGUE_VERSION") == "1":
+    catalogue_version = SharedCatalogueVersion(db.with_name(db.name + "-version"))
+else:
+    catalogue_version = CatalogueVersion()
+
+
+def catalogue_changed():
+    catalogue_version.bump()
+    # older versions can never be read again, so free their memory now
+    response_cache.clear()
+    missing_images.clear()
+
 
+# Typeahead over item and category names. Built (or restored from the snapshot)
+# at startup, then every commit counts the rows added since the previous one.
+SUGGEST_SNAPSHOT = pathlib.Path(os.environ.get("SUGGEST_SNAPSHOT", db.with_suffix(".suggest.json")))
+suggestions = PrefixIndex()
 
-def get_db():
-    if not db.exists():
-         yield
 
-    conn = sqlite3.connect(db, check_same_thread=False )
-    conn.row_factory = sqlite3.Row  # Return rows as dictionaries
+suggestions_version = -1
+
+
+def items_committed(conn: sqlite3.Connection):
+    # the version goes first: cached reads must not outlive the commit even if the catch-up fails
+    catalogue_changed()
+    suggestions.catch_up(conn)
+
+
+def get_suggestions(pool: ConnectionPool = Depends(get_db_pool)) -> PrefixIndex:
+    # rows committed by another worker process only show up as a new catalogue version
+    global suggestions_version
+    version = catalogue_version.value
+    if version != suggestions_version:
+        with pool.connection() as conn:
+            suggestions.catch_up(conn)
+        suggestions_version = version
+    return suggestions
+
+
+def load_suggestions(pool: ConnectionPool):
+    with pool.connection() as conn:
+        if not suggestions.load(SUGGEST_SNAPSHOT, conn):
+            suggestions.build(conn)
+
+
+def save_suggestions(pool: ConnectionPool):
     try:
-        yield conn    
-    finally:
-        conn.close()
+        with pool.connection() as conn:
+            suggestions.save(SUGGEST_SNAPSHOT, conn)
+    except Exception as e:
+        logger.error(f"Could not save the suggestion snapshot: {e}")
+
+
+def cached_json(key: tuple, build, accept_encoding: Optional[str] = None) -> Response:
+    # read the version before the data so a concurrent write can only make the entry unreachable
+    version = catalogue_version.value
+    encoding = negotiate(accept_encoding)
+    headers = {"X-Cache": "HIT", "Vary": "Accept-Encoding"}
+    # a compressed body is cached next to the plain one, so it is only compressed once per version
+    if encoding is not None:
+        body = response_cache.get((version, key, encoding))
+        if body is not None:
+            headers["Content-Encoding"] = encoding
+            return Response(body, media_type="application/json", headers=headers)
+    body = response_cache.get((version, key))
+    if body is None:
+        body = dumps(build())
+        response_cache.put((version, key), body)
+        headers["X-Cache"] = "MISS"
+    if encoding is not None and len(body) >= COMPRESS_MIN_SIZE:
+        body = compress(body, encoding)
+        response_cache.put((version, key, encoding), body)
+        headers["Content-Encoding"] = encoding
+    return Response(body, media_type="application/json", headers=headers)
+
+
+# All item writes go through one connection that group-commits concurrent requests
+def make_item_writer(pool: ConnectionPool) -> SingleWriter:
+    writer = SingleWriter(pool)
+
+    def committed(conn, results):
+        items_committed(conn)
+
+    writer.on_commit(committed)
+    return writer
+
+
+item_writer = make_item_writer(db_pool)
+
+
+def get_item_writer() -> SingleWriter:
+    return item_writer
 
 ##### for STEP 4-1
 # Function to read the items from the JSON file
@@ -46,55 +184,43 @@ def write_from_json(data):
 ############# 
 
 ##### for STEP 4-3
+# Blocking file I/O: call it from a worker thread, not the event loop
 def hash_image(image_file: UploadFile):
     try:
-        # read image from image_file
-        image = image_file.file.read()
-        # hash the image
-        hash_value = hashlib.sha256(image).hexdigest()
-        hashed_image = f"{hash_value}.jpg"
-        hashed_image_path = images / hashed_image
-        
-        with open(hashed_image_path, 'wb') as f:
-            f.write(image)
-        image_file.file.close()
-        return hashed_image
+        # hash and store the image chunk by chunk, skipping the write if it is already stored
+        return image_store.save(image_file.file)
 
+    except UploadTooLarge:
+        raise
     except Exception as e:
         raise RuntimeError(f"An unexpected error occurred: {e}")    
+    finally:
+        image_file.file.close()
 #############
 
 # STEP 5-1: set up the database connection
-def setup_database():
-    conn = sqlite3.connect(db)
-    cursor = conn.cursor()
-    if SQL_File.exists():
-        with open(SQL_File, 'r') as f:
-            cursor.executescript(f.read())
-    conn.commit()
-    conn.close()     
+def setup_database(path: Optional[pathlib.Path] = None):
+    # applies any pending db/migrations; a database that is already current only has its version read
+    conn = sqlite3.connect(path or db)
+    try:
+        migrate(conn)
+    finally:
+        conn.close()
 
 ######### FOR STEP 5
-def get_items_from_db(db: sqlite3.Connection):
+def get_items_from_db(db: sqlite3.Connection, limit: int = DEFAULT_PAGE_SIZE, after: int = 0):
     try:
         cursor = db.cursor()
-        query = """
-        SELECT items.name, categories.name AS category, image_name
-        FROM items
-        JOIN categories
-        ON category_id = categories.id
-        """
-        cursor.execute(query)
+        cursor.execute(SELECT_ITEMS, (after, limit + 1))
         rows = cursor.fetchall()
-        logger.debug(f"Fetched rows: {rows}")
-        items_list = [{"name": name, "category":category, "image_name": image_name} for name, category, image_name in rows]
-        result = {"items": items_list}
+        logger.debug("Fetched rows: %s", rows)
+        result = build_page(rows, limit)
 
         return result
 
     except Exception as e:
         logger.error(f"Error fetching items: {e}")
-        return {f"An unexpected error occurred: {e}"}
+        raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {e}")
     finally:
         cursor.close()
 ###############
@@ -103,24 +229,17 @@ def get_items_from_db(db: sqlite3.Connection):
 def get_items_from_db_by_id(id: int, db: sqlite3.Connection)-> Dict[str, List[Dict[str, str]]]:
     try:
         cursor = db.cursor()
-        logger.debug(f"Executing query to fetch item with ID: {id}")
+        logger.debug("Executing query to fetch item with ID: %s", id)
 
-        query = """
-        SELECT items.id, items.name, categories.name AS category, items.image_name
-        FROM items
-        JOIN categories ON items.category_id = categories.id
-        WHERE items.id = ?
-        """
-
-        cursor.execute(query, (id,))
+        cursor.execute(SELECT_ITEM_BY_ID, (id,))
         row = cursor.fetchone()
 
         if row:
-            logger.debug(f"Found item: {row}")
+            logger.debug("Found item: %s", row)
             item = [{"id": row[0], "name": row[1], "category": row[2], "image_name": row[3]}]
             return {"items": item}
         else:
-            logger.debug(f"No item found for ID: {id}")
+            logger.debug("No item found for ID: %s", id)
             return {"items": []}
     except Exception as e:
         logger.error(f"Error during DB query: {e}")
@@ -130,17 +249,38 @@ def get_items_from_db_by_id(id: int, db: sqlite3.Connection)-> Dict[str, List[Di
 ###########  
 
 
+# Cleared until startup has finished and again once shutdown begins, for /readyz
+ready = threading.Event()
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    setup_database()
+    # serve.py migrates the database, writes the suggestion snapshot and runs image
+    # maintenance once in the parent process, so workers only load the snapshot
+    if os.environ.get("DB_PREPARED") != "1":
+        setup_database()
+    load_suggestions(db_pool)
+    if os.environ.get("IMAGE_MAINTENANCE", "1") == "1":
+        image_maintenance.start()
+    if worker_snapshots is not None:
+        worker_snapshots.start()
+    ready.set()
     yield
+    ready.clear()
+    if worker_snapshots is not None:
+        worker_snapshots.stop()
+    image_maintenance.stop()
+    item_writer.stop()
+    save_suggestions(db_pool)
+    db_pool.close()
+    derivatives.shutdown()
 
 
 app = FastAPI(lifespan=lifespan)
 
 logger = logging.getLogger("uvicorn")
-logger.level = logging.DEBUG # for STEP 4-6
-images = pathlib.Path(__file__).parent.resolve() / "images"
+# DEBUG for STEP 4-6; debug calls use %-style arguments so they cost nothing when disabled
+logger.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
 origins = [os.environ.get("FRONT_URL", "http://localhost:3000")]
 app.add_middleware(
     CORSMiddleware,
@@ -149,6 +289,23 @@ app.add_middleware(
     allow_methods=["GET", "POST", "PUT", "DELETE"],
     allow_headers=["*"],
 )
+# leave room for the name and category form fields next to the image
+BULK_MAX_BODY_SIZE = int(os.environ.get("BULK_MAX_BODY_SIZE", str(1024 * 1024 * 1024)))
+app.add_middleware(
+    BodySizeLimitMiddleware,
+    max_body_size=MAX_UPLOAD_SIZE + 64 * 1024,
+    path_limits={"/items/bulk": BULK_MAX_BODY_SIZE},
+)
+# large streamed exports; cached JSON is compressed by cached_json, and images never are
+app.add_middleware(GZipMiddleware, minimum_size=COMPRESS_MIN_SIZE, compresslevel=GZIP_LEVEL)
+# added last so it is outermost and also times requests rejected by the middleware above
+app.add_middleware(MetricsMiddleware, histogram=http_request_seconds)
+
+
+# every pooled connection stayed busy for DB_POOL_TIMEOUT: the server is overloaded, not broken
+@app.exception_handler(PoolTimeout)
+def pool_timeout(request: Request, exc: PoolTimeout):
+    return JSONResponse({"detail": str(exc)}, status_code=503, headers={"Retry-After": "1"})
 
 
 class HelloResponse(BaseModel):
@@ -160,6 +317,91 @@ def hello():
     return HelloResponse(**{"message": "Hello, world!"})
 
 
+# Liveness: the process is serving requests at all
+@app.get("/livez")
+def livez():
+    return {"status": "ok"}
+
+
+# Readiness: startup has finished and the database answers; load balancers
+# should only send traffic once this returns 200
+@app.get("/readyz")
+def readyz(pool: ConnectionPool = Depends(get_db_pool)):
+    if not ready.is_set():
+        raise HTTPException(status_code=503, detail="Starting up or shutting down")
+    try:
+        with pool.connection() as conn:
+            conn.execute("SELECT 1").fetchone()
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"Database unavailable: {e}")
+    return {"status": "ready"}
+
+
+def worker_stats() -> Dict:
+    return {
+        "catalogue_version": catalogue_version.value,
+        "response_cache": response_cache.stats(),
+        "image_cache": image_cache.stats(),
+        "missing_images": missing_images.stats(),
+        "db_pool": db_pool.stats(),
+        "writer": item_writer.stats(),
+        "suggestions": suggestions.stats(),
+        "image_maintenance": image_maintenance.stats(),
+    }
+
+
+# /metrics gauge families, each taken from one of the stats() dicts above
+GAUGES = {
+    "response_cache": "Response cache counters",
+    "image_cache": "Image cache counters",
+    "db_pool": "Connection pool counters",
+    "writer": "Group commit writer counters",
+    "suggestions": "Suggestion index size",
+    "catalogue": "Catalogue state",
+}
+
+
+def gauge_values(stats: Dict) -> Dict[str, Dict[str, float]]:
+    values = {name: stats[name] for name in GAUGES if name in stats}
+    values["catalogue"] = {"version": stats["catalogue_version"]}
+    return values
+
+
+# With several worker processes (serve.py sets METRICS_DIR) each one only sees its
+# own requests, caches and pool, so they share snapshots and any of them can report
+# all: counters and histograms are summed, gauges and /stats are given per worker
+METRICS_DIR = os.environ.get("METRICS_DIR")
+worker_snapshots = WorkerSnapshots(pathlib.Path(METRICS_DIR), registry, worker_stats) if METRICS_DIR else None
+
+
+# Counters for the caches, the connection pool and the writer
+@app.get("/stats")
+def get_stats():
+    stats = worker_stats()
+    if worker_snapshots is not None:
+        stats["pid"] = os.getpid()
+        stats["workers"] = {
+            snapshot["pid"]: snapshot["state"] for snapshot in worker_snapshots.collect() if snapshot["alive"]
+        }
+    return stats
+
+
+# Prometheus text exposition format
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    if worker_snapshots is None:
+        lines = registry.render()
+        for name, values in gauge_values(worker_stats()).items():
+            lines += render_gauges(name, GAUGES[name], values, "stat")
+    else:
+        snapshots = worker_snapshots.collect()
+        lines = registry.merged([snapshot["metrics"] for snapshot in snapshots]).render()
+        workers = {snapshot["pid"]: gauge_values(snapshot["state"]) for snapshot in snapshots if snapshot["alive"]}
+        for name in GAUGES:
+            lines += render_worker_gauges(name, GAUGES[name], {pid: values[name] for pid, values in workers.items()}, "stat")
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+
 class AddItemResponse(BaseModel):
     message: str
 
@@ -170,37 +412,105 @@ async def add_item(
     name: str = Form(...),
     category: str = Form(...),
     image: UploadFile = File(...),
-    db: sqlite3.Connection = Depends(get_db),
+    writer: SingleWriter = Depends(get_item_writer),
 ):
     try:
         if not name or not category or not image:
             raise HTTPException(status_code=400, detail="name, category, and image are required")
     
-        hashed_image = hash_image(image)
-
-        insert_item_by_db(Item(name=name, category=category, image_name=hashed_image), db)
+        hashed_image = await run_in_threadpool(hash_image, image)
+        missing_images.discard(hashed_image)
+
+        item = Item(name=name, category=category, image_name=hashed_image)
+        # acknowledged once the batch this insert was grouped into has committed
+        await asyncio.wrap_future(writer.submit(lambda conn: insert_item_by_db(item, conn, commit=False)))
+        # thumbnails are rendered in the background; the response does not wait for them,
+        # and the item is already stored, so a render pool that cannot take jobs is only logged
+        try:
+            await run_in_threadpool(derivatives.submit, hashed_image)
+        except Exception as e:
+            logger.error(f"Could not queue variants of {hashed_image}: {e}")
         return AddItemResponse(**{"message": f"item received: {name}, {category}, {hashed_image}"})
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
     except Exception as e:
         logger.error(f"An error occurred while processing the item: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")   
 
+async def read_line_batches(request: Request, batch_size: int):
+    # split the streamed body into lines without ever holding all of it
+    batch, pending, number = [], b"", 1
+    async for chunk in request.stream():
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop()
+        batch.extend(lines)
+        if len(batch) >= batch_size:
+            yield number, batch
+            number += len(batch)
+            batch = []
+    if pending:
+        batch.append(pending)
+    if batch:
+        yield number, batch
+
+
+# Accepts a JSONL body, or a multipart form with a JSONL (or legacy items.json)
+# file in the "file" field. Rows are committed in chunks, and rows that fail
+# are reported back instead of failing the whole request.
+@app.post("/items/bulk")
+async def add_items_bulk(request: Request, pool: ConnectionPool = Depends(get_db_pool)):
+    # the upload is read between chunks at the client's pace, so the load gets its own
+    # connection rather than keeping a pooled one from the read endpoints meanwhile
+    db = await run_in_threadpool(pool.connect)
+    try:
+        ingester = await run_in_threadpool(BulkIngester, db, BULK_CHUNK_SIZE, lambda: items_committed(db))
+        if request.headers.get("content-type", "").startswith("multipart/form-data"):
+            form = await request.form()
+            upload = form.get("file")
+            if upload is None or isinstance(upload, str):
+                raise HTTPException(status_code=400, detail="file is required")
+            await run_in_threadpool(ingester.ingest, parse_file(upload.file, upload.filename))
+        else:
+            async for start, lines in read_line_batches(request, BULK_CHUNK_SIZE):
+                await run_in_threadpool(ingester.ingest, parse_jsonl(lines, start))
+    finally:
+        db.close()
+    return ingester.result()
+
+
  ###### modifying for STEP 5-1
+# Pages are keyed on items.id: pass the returned next_cursor as `after` to get
+# the following page, or set `stream` to export every row in constant memory.
 @app.get("/items")
-def get_items(db: sqlite3.Connection = Depends(get_db)):
-    all_data = get_items_from_db(db)
-    return all_data
+def get_items(
+    request: Request,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    stream: Optional[StreamFormat] = None,
+    pool: ConnectionPool = Depends(get_db_pool),
+):
+    after_id = decode_cursor(after)
+    if stream:
+        return stream_query(pool, SELECT_ITEMS, (after_id, -1), stream)
+
+    def build():
+        with pool.connection() as db:
+            return get_items_from_db(db, limit, after_id)
+
+    return cached_json(("items", limit, after_id), build, request.headers.get("accept-encoding"))
 ########## 
 
 ####### modified for STEP 5   
 @app.get("/items/{item_id}")
-def get_item_by_id(item_id: int, db: sqlite3.Connection = Depends(get_db)):
-    try:
-        logger.debug(f"Fetching item with ID: {item_id}")
-        all_data = get_items_from_db_by_id(item_id, db)
+def get_item_by_id(item_id: int, request: Request, pool: ConnectionPool = Depends(get_db_pool)):
+    def build():
+        logger.debug("Fetching item with ID: %s", item_id)
+        with pool.connection() as db:
+            all_data = get_items_from_db_by_id(item_id, db)
         if isinstance(all_data, dict) and "items" in all_data:
             items = all_data["items"]
             if items:
-                logger.debug(f"Item found: {items[0]}")
+                logger.debug("Item found: %s", items[0])
                 return items[0]
             else:
                 logger.debug("No items found for the given ID")
@@ -208,6 +518,11 @@ def get_item_by_id(item_id: int, db: sqlite3.Connection = Depends(get_db)):
         else:
             logger.error(f"Unexpected response format: {all_data}")
             raise HTTPException(status_code=500, detail="Unexpected response format")
+
+    try:
+        return cached_json(("item", item_id), build, request.headers.get("accept-encoding"))
+    except (HTTPException, PoolTimeout):
+        raise
     except Exception as e:
         logger.error(f"Error fetching item: {e}")
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
@@ -216,45 +531,206 @@ def get_item_by_id(item_id: int, db: sqlite3.Connection = Depends(get_db)):
 
 ######### for STEP 5-2
 @app.get("/search")
-def search_items_by_keyword(keyword: str, db: sqlite3.Connection = Depends(get_db)):
-    try:
-        cursor = db.cursor()
-        query = """
-        SELECT items.name, categories.name AS category_name, items.image_name
-        FROM items
-        JOIN categories ON items.category_id = categories.id
-        WHERE items.name LIKE ?
-        """
-
-        pattern = f"%{keyword}%"
-        cursor.execute(query, (pattern,))
-        rows = cursor.fetchall()
-        items_list =  [{"name": name, "category":category, "image_name": image_name} for name, category, image_name in rows]
-        return  {"items": items_list}
+def search_items_by_keyword(
+    keyword: str,
+    request: Request,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    sort: SearchSort = "id",
+    stream: Optional[StreamFormat] = None,
+    pool: ConnectionPool = Depends(get_db_pool),
+):
+    # matches item and category names through the items_fts index; sort=relevance orders by bm25.
+    # Keywords shorter than 3 characters (e.g. most 2-character Japanese queries) are below
+    # the trigram size, so they fall back to a LIKE scan of every item, in id order
+    query, params, cursor_of = plan_search(keyword, sort, after)
+    if stream:
+        return stream_query(pool, query, params + (-1,), stream)
+
+    def build():
+        with pool.connection() as db:
+            try:
+                cursor = db.cursor()
+                cursor.execute(query, params + (limit + 1,))
+                rows = cursor.fetchall()
+                return build_page(rows, limit, cursor_of)
+
+            except Exception as e:
+                raise HTTPException(status_code=500, detail=f"Error: {e}")
+
+            finally:
+                cursor.close()
+
+    return cached_json(("search", keyword, sort, after, limit), build, request.headers.get("accept-encoding"))
+############
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error: {e}")
 
-    finally:
-        cursor.close()
-############
+# Typeahead for the search box: completions of the whole item or category name,
+# most common first, answered from memory without touching the database
+@app.get("/suggest")
+def suggest(
+    prefix: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(SUGGEST_DEFAULT_LIMIT, ge=1, le=SUGGEST_MAX_LIMIT),
+    index: PrefixIndex = Depends(get_suggestions),
+):
+    completions = index.suggest(prefix, limit)
+    return {"prefix": prefix, "suggestions": [{"text": text, "count": count} for text, count in completions]}
+
+
+# Uploads are sharded by hash prefix; flat-layout files keep working until the
+# maintenance thread has moved them. It also re-hashes stored images to catch
+# corruption and, when IMAGE_GC_INTERVAL is set, deletes unreferenced ones
+image_store = ImageStore(images)
+image_maintenance = ImageMaintenance(image_store, db_pool, on_remove=lambda name: image_removed(name))
+
+
+# Hot images (and the placeholder) are kept in memory so repeat views skip the disk
+IMAGE_CACHE_BYTES = int(os.environ.get("IMAGE_CACHE_BYTES", str(64 * 1024 * 1024)))
+IMAGE_CACHE_MAX_ITEM_BYTES = int(os.environ.get("IMAGE_CACHE_MAX_ITEM_BYTES", str(1024 * 1024)))
+image_cache = LRUCache(IMAGE_CACHE_BYTES, IMAGE_CACHE_MAX_ITEM_BYTES)
+# Counts images removed or quarantined by maintenance. Under serve.py maintenance
+# runs in the parent process, so workers only learn about removals through this
+# shared counter; removals are rare, so a worker then drops its whole image cache.
+if os.environ.get("SHARED_CATALOGUE_VERSION") == "1":
+    image_removals = SharedCatalogueVersion(db.with_name(db.name + "-image-removals"))
+else:
+    image_removals = CatalogueVersion()
+image_cache_removals = image_removals.value
+# Names found missing, so requests for an image no item has uploaded (yet) skip the
+# threadpool hop and the file stats. An entry holds the catalogue version it was
+# seen at and is only trusted at that version, so a write in any worker retires
+# it; the TTL bounds how long a file stored outside the catalogue goes unseen.
+IMAGE_MISS_TTL = float(os.environ.get("IMAGE_MISS_TTL", "10"))
+missing_images = LRUCache(1024 * 1024, ttl=IMAGE_MISS_TTL)
+
+
+def known_missing(image_name: str) -> bool:
+    return missing_images.get(image_name) == catalogue_version.value
+
+
+def remember_missing(image_name: str, version: int):
+    missing_images.put(image_name, version, size=len(image_name))
+
+
+def image_removed(image_name: str):
+    image_cache.discard(image_name)
+    image_removals.bump()
+
+
+def sync_image_cache():
+    global image_cache_removals
+    removals = image_removals.value
+    if removals != image_cache_removals:
+        image_cache.clear()
+        image_cache_removals = removals
+
+
+class CachedImage(NamedTuple):
+    data: Optional[bytes]  # None when the file is too large to keep in memory
+    etag: Optional[str]
+    path: pathlib.Path
+
+
+def load_image(image_name: str) -> Optional[CachedImage]:
+    path = image_store.locate(image_name)
+    if path is None:
+        return None
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            content_addressed = CONTENT_ADDRESSED.match(image_name) is not None
+            if size > IMAGE_CACHE_MAX_ITEM_BYTES:
+                return CachedImage(None, f'"{image_name[:-4]}"' if content_addressed else None, path)
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    etag = f'"{image_name[:-4]}"' if content_addressed else f'"{hashlib.sha256(data).hexdigest()}"'
+    image = CachedImage(data, etag, path)
+    image_cache.put(image_name, image, size=len(data))
+    return image
+
+
+async def lookup_image(image_name: str, cache_missing: bool = True) -> Optional[CachedImage]:
+    sync_image_cache()
+    image = image_cache.get(image_name)
+    if image is None:
+        if known_missing(image_name):
+            return None
+        # read before the lookup, so a write committed meanwhile is not hidden behind the miss
+        version = catalogue_version.value
+        image = await run_in_threadpool(load_image, image_name)
+        if image is None and cache_missing:
+            remember_missing(image_name, version)
+    return image
+
+
+# Resized variants live next to the originals and are rendered in worker processes
+derivatives = DerivativeGenerator(image_store)
+
+
+async def lookup_variant(image_name: str, size: str) -> Optional[CachedImage]:
+    # no original, so no variant either
+    if known_missing(image_name):
+        return None
+    name = variant_name(image_name, size)
+    # variants appear without a catalogue write when a render finishes, so their misses are not kept
+    image = await lookup_image(name, cache_missing=False)
+    if image is not None or not derivatives.enabled:
+        return image
+    version = catalogue_version.value
+    if await run_in_threadpool(image_store.locate, image_name) is None:
+        remember_missing(image_name, version)
+        return None
+    # render it now; concurrent requests for the same variant wait on the same job
+    try:
+        await asyncio.wrap_future(await run_in_threadpool(derivatives.ensure, image_name, size))
+    except Exception as e:
+        logger.error(f"Could not render {name}: {e}")
+        return None
+    return await lookup_image(name, cache_missing=False)
 
 
 # get_image is a handler to return an image for GET /images/{filename} .
 @app.get("/image/{image_name}")
-async def get_image(image_name: str):
-    # Create image path
-    image = images / image_name
-
+async def get_image(image_name: str, request: Request, size: Optional[VariantSize] = None):
     if not image_name.endswith(".jpg"):
         raise HTTPException(status_code=400, detail="Image path does not end with .jpg")
 
-    if not image.exists():
-        
-        logger.debug(f"Image not found: {image}")
-        image = images / "default.jpg"
-
-    return FileResponse(image)
+    # ?size= only applies to uploaded originals; anything else is served as is
+    fallback = False
+    if size is not None and CONTENT_ADDRESSED.match(image_name) and "_" not in image_name:
+        image = await lookup_variant(image_name, size)
+        if image is not None:
+            image_name = variant_name(image_name, size)
+        else:
+            # the original stands in for a variant that could not be rendered; it is
+            # revalidated rather than cached for good under the variant's URL
+            fallback = True
+
+    if_none_match = request.headers.get("if-none-match")
+    content_addressed = CONTENT_ADDRESSED.match(image_name) is not None and not fallback
+    # the name is the content hash, so a matching ETag is enough to answer without any I/O
+    if content_addressed and etag_matches(if_none_match, f'"{image_name[:-4]}"'):
+        return Response(status_code=304, headers=cache_headers(f'"{image_name[:-4]}"', IMMUTABLE))
+
+    image = await lookup_image(image_name)
+    if image is None:
+        logger.debug("Image not found: %s", image_name)
+        image = await lookup_image("default.jpg")
+        # the real image may still be uploaded later, so the placeholder is revalidated
+        content_addressed = False
+        if image is None:
+            raise HTTPException(status_code=404, detail="Image not found")
+
+    cache_control = IMMUTABLE if content_addressed else REVALIDATE
+    if image.etag is None:
+        return FileResponse(image.path, headers={"Cache-Control": cache_control})
+    headers = cache_headers(image.etag, cache_control)
+    if etag_matches(if_none_match, image.etag):
+        return Response(status_code=304, headers=headers)
+    if image.data is None:
+        return FileResponse(image.path, headers=headers)
+    return bytes_response(request, image.data, headers, media_type="image/jpeg")
 
 
 class Item(BaseModel):
@@ -265,27 +741,28 @@ class Item(BaseModel):
 
 
 
-def insert_item_by_db(item: Item, db: sqlite3.Connection) -> int:
+# commit=False leaves the transaction to the caller, e.g. the group-committing writer;
+# either way the caller runs items_committed() once the rows are durable
+def insert_item_by_db(item: Item, db: sqlite3.Connection, commit: bool = True) -> int:
     try:
         cursor = db.cursor()
-        query_category = "SELECT id FROM categories WHERE name = ?"
-        cursor.execute(query_category, (item.category,))
+        cursor.execute(SELECT_CATEGORY_ID, (item.category,))
         rows = cursor.fetchone()
         if rows is None:
-            insert_query_category = "INSERT INTO categories (name) VALUES (?)"
-            cursor.execute(insert_query_category, (item.category,))
-            category_id = cursor.lastrowid
-            print(f"Inserted new category with id {category_id}")
+            cursor.execute(UPSERT_CATEGORY, (item.category,))
+            cursor.execute(SELECT_CATEGORY_ID, (item.category,))
+            rows = cursor.fetchone()
+            logger.debug("Inserted new category with id %s", rows[0])
         else:
-            category_id = rows[0]
-            print(f"Category {item.category} found with id {category_id}")
-        query = """
-        INSERT INTO items (name, category_id, image_name) VALUES (?, ?, ?)
-        """
-        cursor.execute(query, (item.name, category_id, item.image_name))
-
-        db.commit()
-        print(f"Inserted item into DB: {item.name}, {category_id}, {item.image_name}")
+            logger.debug("Category %s found with id %s", item.category, rows[0])
+        category_id = rows[0]
+        cursor.execute(INSERT_ITEM, (item.name, category_id, item.image_name))
+        item_id = cursor.lastrowid
+
+        if commit:
+            db.commit()
+        logger.debug("Inserted item into DB: %s, %s, %s", item.name, category_id, item.image_name)
+        return item_id
     except Exception as e:
         logger.error(f"Error inserting item into DB: {str(e)}")
         raise RuntimeError(f"An unexpected error occurred while inserting the item: {e}")
@@ -1,44 +1,68 @@
 from fastapi.testclient import TestClient
-from main import app, get_db
+from main import app, get_db, get_db_pool, get_item_writer, make_item_writer, insert_item_by_db, Item
+from migrations import migrate
+from suggest import PrefixIndex
+from writer import SingleWriter
+from search import backfill_search_index
+from storage import FILE_MODE, ImageStore, UploadTooLarge, save_image
+from maintenance import collect_garbage, migrate_store, scan_integrity
+from middleware import BodySizeLimitMiddleware
+from fastapi import FastAPI, Request
+import io
+import shutil
+import hashlib
+import main
+from cache import LRUCache, SharedCatalogueVersion
+from pagination import encode_cursor, encode_rank_cursor
+from metrics import WorkerSnapshots
+from compression import negotiate
+from serve import available_cpus
+from bulk import BulkIngester
+from benchmark import report
+from benchmark.generate import build_catalogue, generate_items
+from derivatives import DerivativeGenerator, variant_name
+from PIL import Image
+from database import INDEX_ITEMS_FTS_AFTER, ConnectionPool, PoolTimeout
+from concurrent.futures.process import BrokenProcessPool
 import pytest
 import sqlite3
 import os
+import json
 import pathlib
 
 # STEP 6-4: uncomment this test setup
 test_db = pathlib.Path(__file__).parent.resolve() / "db" / "test_mercari.sqlite3"
+test_image = pathlib.Path(__file__).parent.resolve() / "images" / "default.jpg"
+test_pool = ConnectionPool(test_db, size=2)
 
 def override_get_db():
-    conn = sqlite3.connect(test_db)
-    conn.row_factory = sqlite3.Row
-    try:
+    with test_pool.connection() as conn:
         yield conn
-    finally:
-        conn.close()
 
  
 app.dependency_overrides[get_db] = override_get_db  
+app.dependency_overrides[get_db_pool] = lambda: test_pool
+test_writer = make_item_writer(test_pool)
+app.dependency_overrides[get_item_writer] = lambda: test_writer
 
 @pytest.fixture(autouse=True)
 def db_connection():
      # Before the test is done, create a test database
     conn = sqlite3.connect(test_db)
-    cursor = conn.cursor()
-    cursor.execute(
-        """CREATE TABLE IF NOT EXISTS items (
- 		id INTEGER PRIMARY KEY AUTOINCREMENT,
- 		name VARCHAR(255),
- 		category VARCHAR(255)
- 	)"""
-    )
-    conn.commit()
+    migrate(conn)
     conn.row_factory = sqlite3.Row  # Return rows as dictionaries
+    # each test starts from a fresh database, so drop responses cached by earlier tests
+    main.catalogue_changed()
+    main.suggestions.clear()
     yield conn
 
     conn.close()
-    # After the test is done, remove the test database
-    if test_db.exists():
-        test_db.unlink() # Remove the file
+    test_writer.stop()
+    test_pool.close()
+    # After the test is done, remove the test database and its WAL files
+    for path in (test_db, test_db.with_name(test_db.name + "-wal"), test_db.with_name(test_db.name + "-shm")):
+        if path.exists():
+            path.unlink() # Remove the file
 
 client = TestClient(app)
 
@@ -67,9 +91,10 @@ def test_hello(want_status_code, want_body):
         ({"name":"", "category":"cosmetics"}, 422),
     ],
 )
-def test_add_item_e2e(args,want_status_code,db_connection):
+def test_add_item_e2e(args,want_status_code,db_connection,image_dir):
 
-    response = client.post("/items/", data=args)
+    with open(test_image, "rb") as f:
+        response = client.post("/items/", data=args, files={"image": ("default.jpg", f, "image/jpeg")})
     assert response.status_code == want_status_code
     
     if want_status_code >= 400:
@@ -86,4 +111,827 @@ def test_add_item_e2e(args,want_status_code,db_connection):
     db_item = cursor.fetchone()
     assert db_item is not None
     assert dict(db_item)["name"] == args["name"]
-        
\ No newline at end of file
+
+
+def test_pool_reuses_connections():
+    pool = ConnectionPool(test_db, size=1)
+    with pool.connection() as first:
+        pass
+    with pool.connection() as second:
+        assert second is first
+        assert second.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        assert second.execute("PRAGMA synchronous").fetchone()[0] == 1  # NORMAL
+    assert pool.stats()["open"] == 1
+    assert pool.stats()["checkouts"] == 2
+    pool.close()
+
+
+def test_pool_times_out_when_exhausted():
+    pool = ConnectionPool(test_db, size=1, timeout=0.05)
+    with pool.connection():
+        with pytest.raises(PoolTimeout):
+            pool.acquire()
+    assert pool.stats()["wait_seconds_max"] >= 0.05
+    pool.close()
+
+
+def seed_items(conn, names):
+    conn.execute("INSERT INTO categories (name) VALUES ('fashion') ON CONFLICT (name) DO NOTHING")
+    conn.executemany(
+        "INSERT INTO items (name, category_id, image_name) VALUES (?, 1, 'default.jpg')",
+        [(name,) for name in names],
+    )
+    conn.commit()
+    main.items_committed(conn)
+
+
+def test_get_items_keyset_pagination(db_connection):
+    seed_items(db_connection, [f"jacket {i}" for i in range(5)])
+
+    first = client.get("/items", params={"limit": 2}).json()
+    assert [item["name"] for item in first["items"]] == ["jacket 0", "jacket 1"]
+    assert first["next_cursor"] is not None
+
+    second = client.get("/items", params={"limit": 2, "after": first["next_cursor"]}).json()
+    assert [item["name"] for item in second["items"]] == ["jacket 2", "jacket 3"]
+
+    last = client.get("/items", params={"limit": 2, "after": second["next_cursor"]}).json()
+    assert [item["name"] for item in last["items"]] == ["jacket 4"]
+    assert last["next_cursor"] is None
+
+
+@pytest.mark.parametrize("after", ["not a cursor", encode_cursor(2**63), encode_cursor(-1)])
+def test_get_items_rejects_bad_cursor(after):
+    assert client.get("/items", params={"after": after}).status_code == 400
+
+
+@pytest.mark.parametrize("after", [encode_rank_cursor(-1.0, 2**63), encode_rank_cursor(float("nan"), 1)])
+def test_search_rejects_bad_rank_cursor(after):
+    response = client.get("/search", params={"keyword": "jacket", "sort": "relevance", "after": after})
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize("stream", ["ndjson", "json"])
+def test_get_items_stream(stream, db_connection):
+    seed_items(db_connection, [f"jacket {i}" for i in range(3)])
+
+    response = client.get("/items", params={"stream": stream, "limit": 1})
+    assert response.status_code == 200
+    if stream == "ndjson":
+        items = [json.loads(line) for line in response.text.splitlines()]
+    else:
+        items = response.json()["items"]
+    assert [item["name"] for item in items] == ["jacket 0", "jacket 1", "jacket 2"]
+
+
+def test_get_items_stream_does_not_use_a_pooled_connection(db_connection):
+    seed_items(db_connection, ["jacket"])
+    pool = ConnectionPool(test_db, size=1, timeout=0.1)
+    app.dependency_overrides[get_db_pool] = lambda: pool
+    try:
+        with pool.connection():
+            # the only pooled connection is taken, yet the export still runs
+            response = client.get("/items", params={"stream": "ndjson"})
+            assert [json.loads(line)["name"] for line in response.text.splitlines()] == ["jacket"]
+            # while a page has to wait for it, and gives up with 503
+            response = client.get("/items")
+            assert response.status_code == 503
+            assert response.headers["retry-after"] == "1"
+    finally:
+        app.dependency_overrides[get_db_pool] = lambda: test_pool
+        pool.close()
+
+
+def test_search_pagination(db_connection):
+    seed_items(db_connection, ["jacket", "shirt", "down jacket", "jacket 2"])
+
+    first = client.get("/search", params={"keyword": "jacket", "limit": 2}).json()
+    assert [item["name"] for item in first["items"]] == ["jacket", "down jacket"]
+
+    second = client.get("/search", params={"keyword": "jacket", "limit": 2, "after": first["next_cursor"]}).json()
+    assert [item["name"] for item in second["items"]] == ["jacket 2"]
+    assert second["next_cursor"] is None
+
+
+@pytest.mark.parametrize(
+    "keyword, want_names",
+    [
+        ("fashion", ["jacket", "ジャケット 黒", "黒いジャケット"]),  # category names are indexed too
+        ("ジャケット", ["ジャケット 黒", "黒いジャケット"]),
+        ("JACK", ["jacket"]),
+        ("黒", ["ジャケット 黒", "黒いジャケット"]),  # shorter than a trigram, falls back to LIKE
+        ("fa", ["jacket", "ジャケット 黒", "黒いジャケット"]),  # which matches category names as well
+    ],
+)
+def test_search_full_text(keyword, want_names, db_connection):
+    seed_items(db_connection, ["jacket", "ジャケット 黒", "黒いジャケット"])
+
+    response = client.get("/search", params={"keyword": keyword})
+    assert response.status_code == 200
+    assert [item["name"] for item in response.json()["items"]] == want_names
+
+
+def test_search_relevance_pagination(db_connection):
+    seed_items(db_connection, ["red coat with a long red lining", "red", "blue red"])
+
+    first = client.get("/search", params={"keyword": "red", "sort": "relevance", "limit": 2}).json()
+    second = client.get("/search", params={"keyword": "red", "sort": "relevance", "limit": 2, "after": first["next_cursor"]}).json()
+    names = [item["name"] for item in first["items"] + second["items"]]
+    assert names[0] == "red"
+    assert sorted(names) == sorted(["red coat with a long red lining", "red", "blue red"])
+    assert second["next_cursor"] is None
+
+
+def test_search_index_follows_updates_and_deletes(db_connection):
+    seed_items(db_connection, ["jacket", "shirt"])
+    db_connection.execute("UPDATE items SET name = 'sweater' WHERE name = 'jacket'")
+    db_connection.execute("DELETE FROM items WHERE name = 'shirt'")
+    db_connection.execute("UPDATE categories SET name = 'tops'")
+    db_connection.commit()
+
+    assert client.get("/search", params={"keyword": "jacket"}).json()["items"] == []
+    assert client.get("/search", params={"keyword": "shirt"}).json()["items"] == []
+    assert [item["name"] for item in client.get("/search", params={"keyword": "tops"}).json()["items"]] == ["sweater"]
+
+
+def test_backfill_search_index(db_connection):
+    seed_items(db_connection, ["jacket"])
+    db_connection.execute("DELETE FROM items_fts")
+    backfill_search_index(db_connection)
+    db_connection.commit()
+
+    assert [item["name"] for item in client.get("/search", params={"keyword": "jacket"}).json()["items"]] == ["jacket"]
+
+
+class NonSeekable(io.BytesIO):
+    def seekable(self):
+        return False
+
+
+@pytest.mark.parametrize("wrap", [io.BytesIO, NonSeekable])
+def test_save_image_stores_by_hash(wrap, tmp_path):
+    data = b"jpeg bytes" * 1000
+    name = save_image(wrap(data), tmp_path, chunk_size=1024)
+
+    assert name == f"{hashlib.sha256(data).hexdigest()}.jpg"
+    assert (tmp_path / name).read_bytes() == data
+    assert [path.name for path in tmp_path.iterdir()] == [name]  # no temp files left behind
+    assert (tmp_path / name).stat().st_mode & 0o777 == FILE_MODE
+
+
+def test_save_image_skips_existing(tmp_path):
+    data = b"jpeg bytes"
+    name = save_image(io.BytesIO(data), tmp_path)
+    stored = tmp_path / name
+    inode = stored.stat().st_ino
+    os.utime(stored, ns=(0, 0))
+
+    assert save_image(io.BytesIO(data), tmp_path) == name
+    assert stored.stat().st_ino == inode  # not rewritten
+    # but touched, so the garbage collector's grace period starts again
+    assert stored.stat().st_mtime_ns != 0
+
+
+@pytest.mark.parametrize("wrap", [io.BytesIO, NonSeekable])
+def test_save_image_rejects_large_upload(wrap, tmp_path):
+    with pytest.raises(UploadTooLarge):
+        save_image(wrap(b"x" * 2048), tmp_path, max_size=1024, chunk_size=256)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_body_size_limit():
+    limited = FastAPI()
+    limited.add_middleware(BodySizeLimitMiddleware, max_body_size=1024)
+
+    @limited.post("/echo")
+    async def echo(request: Request):
+        return {"size": len(await request.body())}
+
+    limited_client = TestClient(limited)
+    assert limited_client.post("/echo", content=b"x" * 1024).json() == {"size": 1024}
+    assert limited_client.post("/echo", content=b"x" * 1025).status_code == 413
+    # chunked bodies have no Content-Length and are cut off while streaming
+    assert limited_client.post("/echo", content=iter([b"x" * 1000, b"x" * 1000])).status_code == 413
+
+
+@pytest.fixture
+def image_dir(tmp_path, monkeypatch):
+    shutil.copy(test_image, tmp_path / "default.jpg")
+    monkeypatch.setattr(main, "images", tmp_path)
+    store = ImageStore(tmp_path)
+    monkeypatch.setattr(main, "image_store", store)
+    generator = DerivativeGenerator(store, workers=1)
+    monkeypatch.setattr(main, "derivatives", generator)
+    main.image_cache.clear()
+    yield tmp_path
+    generator.shutdown()
+    main.image_cache.clear()
+
+
+def test_get_image_is_cacheable(image_dir):
+    data = b"jpeg bytes"
+    name = save_image(io.BytesIO(data), image_dir)
+
+    response = client.get(f"/image/{name}")
+    assert response.status_code == 200
+    assert response.content == data
+    assert response.headers["etag"] == f'"{name[:-4]}"'
+    assert "immutable" in response.headers["cache-control"]
+
+    # served from memory even after the file is gone
+    (image_dir / name).unlink()
+    assert client.get(f"/image/{name}").content == data
+    assert main.image_cache.stats()["hits"] == 1
+
+    response = client.get(f"/image/{name}", headers={"If-None-Match": response.headers["etag"]})
+    assert response.status_code == 304
+
+
+@pytest.mark.parametrize(
+    "range_header, want_status, want_body",
+    [
+        ("bytes=0-3", 206, b"0123"),
+        ("bytes=6-", 206, b"6789"),
+        ("bytes=-2", 206, b"89"),
+        ("bytes=20-30", 416, b""),
+        ("bytes=0-1,4-5", 200, b"0123456789"),  # multiple ranges are served whole
+    ],
+)
+def test_get_image_range(range_header, want_status, want_body, image_dir):
+    name = save_image(io.BytesIO(b"0123456789"), image_dir)
+
+    response = client.get(f"/image/{name}", headers={"Range": range_header})
+    assert response.status_code == want_status
+    assert response.content == want_body
+
+
+def test_get_image_placeholder_is_revalidated(image_dir):
+    response = client.get(f"/image/{'0' * 64}.jpg")
+    assert response.status_code == 200
+    assert response.content == test_image.read_bytes()
+    assert response.headers["cache-control"] == "no-cache"
+
+    response = client.get(f"/image/{'0' * 64}.jpg", headers={"If-None-Match": response.headers["etag"]})
+    assert response.status_code == 304
+
+
+def test_lru_cache_is_bounded_by_bytes():
+    cache = LRUCache(max_bytes=10, max_item_bytes=6)
+    cache.put("a", b"aaaa")
+    cache.put("b", b"bbbb")
+    cache.get("a")  # b is now the least recently used
+    cache.put("c", b"cccc")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == b"aaaa"
+    assert cache.put("big", b"x" * 7) is False
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["bytes"] == 8
+
+
+def make_jpeg(width, height):
+    buffer = io.BytesIO()
+    Image.new("RGB", (width, height), "red").save(buffer, "JPEG")
+    buffer.seek(0)
+    return buffer
+
+
+@pytest.mark.parametrize("size, want_edge", [("thumb", 240), ("detail", 800)])
+def test_get_image_variant_is_rendered_lazily(size, want_edge, image_dir):
+    name = save_image(make_jpeg(1600, 1200), image_dir)
+
+    response = client.get(f"/image/{name}", params={"size": size})
+    assert response.status_code == 200
+    assert response.headers["etag"] == f'"{variant_name(name, size)[:-4]}"'
+    assert "immutable" in response.headers["cache-control"]
+    assert Image.open(io.BytesIO(response.content)).size == (want_edge, want_edge * 3 // 4)
+    # rendered into the original's shard, even though the original is still in the flat layout
+    variant = image_dir / name[:2] / name[2:4] / variant_name(name, size)
+    assert variant.stat().st_mode & 0o777 == FILE_MODE
+
+
+def test_variant_jobs_are_shared(image_dir):
+    name = save_image(make_jpeg(400, 400), image_dir)
+
+    first = main.derivatives.ensure(name, "thumb")
+    second = main.derivatives.ensure(name, "thumb")
+    assert first is second
+    first.result(timeout=30)
+
+
+def test_variant_render_recovers_from_a_broken_pool(image_dir):
+    name = save_image(make_jpeg(400, 400), image_dir)
+    generator = main.derivatives
+    # a worker that dies breaks the whole pool
+    with pytest.raises(BrokenProcessPool):
+        generator._pool().submit(os._exit, 1).result(timeout=30)
+
+    generator.ensure(name, "thumb").result(timeout=30)
+    assert generator._failed == {}
+
+
+def test_add_item_survives_a_failing_render_queue(db_connection, image_dir, monkeypatch):
+    def broken(image_name):
+        raise BrokenProcessPool("a worker died")
+
+    monkeypatch.setattr(main.derivatives, "submit", broken)
+    with open(test_image, "rb") as f:
+        response = client.post("/items", data={"name": "coat", "category": "fashion"}, files={"image": ("default.jpg", f, "image/jpeg")})
+    assert response.status_code == 200
+    assert db_connection.execute("SELECT COUNT(*) FROM items").fetchone()[0] == 1
+
+
+def test_get_image_variant_of_missing_image(image_dir):
+    response = client.get(f"/image/{'0' * 64}.jpg", params={"size": "thumb"})
+    assert response.status_code == 200
+    assert response.content == test_image.read_bytes()
+
+
+def test_get_image_remembers_missing_images(image_dir, monkeypatch):
+    data = make_jpeg(40, 30).getvalue()
+    name = f"{hashlib.sha256(data).hexdigest()}.jpg"
+    assert client.get(f"/image/{name}").content == test_image.read_bytes()
+
+    # the miss is remembered, for the original and for its variants
+    with monkeypatch.context() as patch:
+        patch.setattr(main, "load_image", lambda image_name: pytest.fail("looked up again"))
+        patch.setattr(main.image_store, "locate", lambda image_name: pytest.fail("looked up again"))
+        assert client.get(f"/image/{name}").content == test_image.read_bytes()
+        assert client.get(f"/image/{name}", params={"size": "thumb"}).content == test_image.read_bytes()
+
+    # until the image is uploaded
+    response = client.post("/items", data={"name": "coat", "category": "fashion"}, files={"image": (name, data, "image/jpeg")})
+    assert response.json()["message"].endswith(name)
+    assert client.get(f"/image/{name}").content == data
+
+
+def test_get_image_variant_render_failure_is_remembered(image_dir, monkeypatch):
+    name = save_image(io.BytesIO(b"not a jpeg"), image_dir)
+
+    response = client.get(f"/image/{name}", params={"size": "thumb"})
+    assert response.content == b"not a jpeg"
+    assert response.headers["cache-control"] == "no-cache"
+    # the failure is remembered, so the next request does not queue another job
+    monkeypatch.setattr(main.derivatives, "_pool", lambda: pytest.fail("rendered again"))
+    response = client.get(f"/image/{name}", params={"size": "detail"})
+    assert response.content == b"not a jpeg"
+
+
+def test_add_items_bulk_jsonl(db_connection):
+    body = "\n".join([
+        json.dumps({"name": "jacket", "category": "fashion", "image_name": "default.jpg"}),
+        "{not json",
+        json.dumps({"name": "", "category": "fashion"}),
+        json.dumps({"name": "camera", "category": "electronics"}),
+        json.dumps({"name": "coat", "category": "fashion"}),
+    ])
+    response = client.post("/items/bulk", content=body, headers={"Content-Type": "application/x-ndjson"})
+    assert response.status_code == 200
+    result = response.json()
+    assert result["inserted"] == 3
+    assert [error["row"] for error in result["errors"]] == [2, 3]
+
+    rows = db_connection.execute(
+        "SELECT items.name, categories.name FROM items JOIN categories ON category_id = categories.id ORDER BY items.id"
+    ).fetchall()
+    assert [tuple(row) for row in rows] == [("jacket", "fashion"), ("camera", "electronics"), ("coat", "fashion")]
+    assert db_connection.execute("SELECT COUNT(*) FROM categories").fetchone()[0] == 2
+    # bulk loads index their rows in one statement per chunk instead of the per-row trigger
+    assert [item["name"] for item in client.get("/search", params={"keyword": "fashion"}).json()["items"]] == ["jacket", "coat"]
+
+
+def test_add_items_bulk_legacy_file(db_connection):
+    legacy = json.dumps({"items": [{"name": "jacket", "category": "fashion", "image_name": " "}] * 3})
+    response = client.post("/items/bulk", files={"file": ("items.json", legacy, "application/json")})
+    assert response.json() == {"inserted": 3, "failed": 0, "errors": []}
+
+
+def test_add_items_bulk_does_not_use_a_pooled_connection(db_connection):
+    pool = ConnectionPool(test_db, size=1, timeout=0.1)
+    app.dependency_overrides[get_db_pool] = lambda: pool
+    try:
+        with pool.connection():
+            body = json.dumps({"name": "jacket", "category": "fashion"})
+            response = client.post("/items/bulk", content=body, headers={"Content-Type": "application/x-ndjson"})
+        assert response.json()["inserted"] == 1
+        assert pool.stats()["open"] == 1
+    finally:
+        app.dependency_overrides[get_db_pool] = lambda: test_pool
+        pool.close()
+
+
+def test_bulk_ingester_isolates_failing_rows(db_connection):
+    db_connection.execute(
+        "CREATE TRIGGER reject_broken BEFORE INSERT ON items WHEN new.name = 'broken' BEGIN SELECT RAISE(ABORT, 'broken row'); END"
+    )
+    db_connection.commit()
+    ingester = BulkIngester(db_connection, chunk_size=10)
+    ingester.ingest(enumerate([{"name": name, "category": "fashion"} for name in ["a", "broken", "c"]], start=1))
+
+    assert ingester.result()["inserted"] == 2
+    assert ingester.result()["errors"] == [{"row": 2, "error": "broken row"}]
+
+
+def test_bulk_ingester_does_not_retry_committed_chunks(db_connection):
+    def failing_callback():
+        raise sqlite3.OperationalError("callback failed")
+
+    ingester = BulkIngester(db_connection, chunk_size=10, on_commit=failing_callback)
+    ingester.ingest(enumerate([{"name": name, "category": "fashion"} for name in ["a", "b"]], start=1))
+
+    assert ingester.result()["inserted"] == 2
+    assert db_connection.execute("SELECT COUNT(*) FROM items").fetchone()[0] == 2
+
+
+def test_single_writer_group_commits(db_connection):
+    opened = test_pool.stats()["open"]
+    writer = SingleWriter(test_pool, max_batch=50, max_delay=0.05)
+    committed = []
+    writer.on_commit(lambda conn, results: committed.append(results))
+
+    def insert(name):
+        return lambda conn: insert_item_by_db(Item(name=name, category="fashion", image_name="default.jpg"), conn, commit=False)
+
+    def broken(conn):
+        conn.execute("INSERT INTO items (name, category_id) VALUES ('half written', 1)")
+        raise RuntimeError("broken write")
+
+    futures = [writer.submit(insert(f"jacket {i}")) for i in range(10)]
+    failing = writer.submit(broken)
+    ids = [future.result(timeout=5) for future in futures]
+    with pytest.raises(RuntimeError):
+        failing.result(timeout=5)
+    writer.stop()
+
+    assert ids == sorted(set(ids))
+    stats = writer.stats()
+    assert stats["writes"] == 10 and stats["failed_writes"] == 1
+    assert stats["batches"] < 10  # grouped into shared transactions
+    assert test_pool.stats()["open"] == opened  # the writer's connection is not one of the pool's
+    assert sum(len(batch) for batch in committed) == 10
+    names = [row[0] for row in db_connection.execute("SELECT name FROM items ORDER BY id")]
+    assert names == [f"jacket {i}" for i in range(10)]
+
+
+def test_writer_commit_hook_does_not_need_a_pooled_connection(db_connection):
+    pool = ConnectionPool(test_db, size=2, timeout=0.1)
+    writer = make_item_writer(pool)
+    version = main.catalogue_version.value
+    with pool.connection():
+        item = Item(name="jacket", category="fashion", image_name="default.jpg")
+        writer.submit(lambda conn: insert_item_by_db(item, conn, commit=False)).result(timeout=5)
+        writer.stop()
+    assert pool.stats()["open"] == 1  # the writer's connection is not one of the pool's
+    pool.close()
+    assert main.catalogue_version.value > version
+    assert main.suggestions.suggest("jac") == [("jacket", 1)]
+
+
+def test_read_cache_is_invalidated_by_writes(db_connection, image_dir):
+    seed_items(db_connection, ["jacket"])
+
+    first = client.get("/items")
+    assert first.headers["x-cache"] == "MISS"
+    second = client.get("/items")
+    assert second.headers["x-cache"] == "HIT"
+    assert second.content == first.content
+
+    with open(test_image, "rb") as f:
+        response = client.post("/items", data={"name": "coat", "category": "fashion"}, files={"image": ("default.jpg", f, "image/jpeg")})
+    assert response.status_code == 200
+
+    third = client.get("/items")
+    assert third.headers["x-cache"] == "MISS"
+    assert [item["name"] for item in third.json()["items"]] == ["jacket", "coat"]
+    assert client.get("/stats").json()["response_cache"]["hits"] >= 1
+
+
+def test_get_item_by_id_not_found():
+    assert client.get("/items/12345").status_code == 404
+
+
+def test_lru_cache_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("cache.time.monotonic", lambda: now[0])
+    cache = LRUCache(max_bytes=100, ttl=10)
+    cache.put("a", b"a")
+    now[0] += 9
+    assert cache.get("a") == b"a"
+    now[0] += 1
+    assert cache.get("a") is None
+    assert cache.stats()["expirations"] == 1
+
+
+def test_metrics_endpoint(db_connection):
+    seed_items(db_connection, ["jacket"])
+    client.get("/items/1")
+    client.get("/items/1")
+
+    body = client.get("/metrics").text
+    assert 'http_request_duration_seconds_count{method="GET",route="/items/{item_id}",status="200"}' in body
+    assert 'sql_query_duration_seconds_count{query="select_item_by_id"}' in body
+    assert 'response_cache{stat="hits"}' in body
+
+
+def test_metrics_cover_every_worker(db_connection, tmp_path, monkeypatch):
+    snapshots = WorkerSnapshots(tmp_path, main.registry, main.worker_stats)
+    monkeypatch.setattr(main, "worker_snapshots", snapshots)
+    client.get("/items")
+    # another worker's snapshot: the parent process stands in for a live sibling
+    other = json.loads(json.dumps({"pid": os.getppid(), "metrics": main.registry.snapshot(), "state": main.worker_stats()}))
+    (tmp_path / f"worker-{os.getppid()}.json").write_text(json.dumps(other))
+
+    body = client.get("/metrics").text
+    route = 'http_request_duration_seconds_count{method="GET",route="/items",status="200"}'
+    own = main.http_request_seconds.count(method="GET", route="/items", status="200")
+    assert f"{route} {2 * own}" in body  # summed over both workers
+    assert f'db_pool{{stat="size",worker="{os.getpid()}"}}' in body
+    assert f'db_pool{{stat="size",worker="{os.getppid()}"}}' in body
+
+    stats = client.get("/stats").json()
+    assert stats["pid"] == os.getpid()
+    assert sorted(stats["workers"]) == sorted([str(os.getpid()), str(os.getppid())])
+
+
+def test_slow_queries_are_logged(db_connection, monkeypatch, caplog):
+    monkeypatch.setattr("database.DB_SLOW_QUERY_SECONDS", 0.0)
+    with caplog.at_level("WARNING", logger="uvicorn"):
+        with test_pool.connection() as conn:
+            conn.execute("SELECT 1").fetchall()
+            conn.execute(main.SELECT_ITEM_BY_ID, (1,)).fetchall()
+            conn.executemany(main.INSERT_ITEM, [("a", 1, None), ("b", 1, None)])
+            conn.execute(INDEX_ITEMS_FTS_AFTER, (0,))
+    messages = [record.getMessage() for record in caplog.records]
+    assert any("Slow query select" in message for message in messages)
+    # multi-line SQL is logged on one line
+    assert any(message.endswith("FROM items JOIN categories ON items.category_id = categories.id WHERE items.id = ?") for message in messages)
+    # bulk statements are not reported
+    assert not any("insert_item" in message or "index_items_fts" in message for message in messages)
+
+
+
+def test_generated_catalogue_is_seeded_and_skewed(tmp_path):
+    first = [record for _, record in generate_items(2000, ["a.jpg"], seed=7)]
+    assert first == [record for _, record in generate_items(2000, ["a.jpg"], seed=7)]
+    categories = [record["category"] for record in first]
+    assert categories.count("fashion") > categories.count("games") * 5
+
+    db_path = build_catalogue(tmp_path, items=500, images=3, seed=7)
+    with sqlite3.connect(db_path) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM items").fetchone()[0] == 500
+        assert conn.execute("SELECT COUNT(*) FROM items_fts").fetchone()[0] == 500
+    assert len(list((tmp_path / "images").rglob("*.jpg"))) == 4
+
+
+def test_benchmark_report_and_compare():
+    baseline = report.build_report({"items": [0.001 * n for n in range(1, 101)]}, {}, 1.0, {})
+    row = baseline["endpoints"]["items"]
+    assert (row["requests"], row["p50_ms"], row["p99_ms"]) == (100, 50.0, 99.0)
+
+    slower = report.build_report({"items": [0.002 * n for n in range(1, 101)]}, {"items": 1}, 1.0, {})
+    assert report.compare(baseline, baseline) == []
+    assert any(line.startswith("items p95_ms") for line in report.compare(slower, baseline))
+
+
+def test_migrations_are_applied_once(tmp_path):
+    conn = sqlite3.connect(tmp_path / "fresh.sqlite3")
+    applied = migrate(conn)
+    assert [migration.version for migration in applied] == [1, 2, 3]
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == 3
+    # a current database is left alone
+    assert migrate(conn) == []
+    conn.close()
+
+
+def test_migrations_adopt_legacy_database(tmp_path):
+    # a database created by the old db/items.sql, with a category inserted twice
+    conn = sqlite3.connect(tmp_path / "legacy.sqlite3")
+    conn.executescript(
+        "CREATE TABLE categories (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL);"
+        "CREATE TABLE items (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL,"
+        " category_id INTEGER NOT NULL, image_name TEXT);"
+        "INSERT INTO categories (name) VALUES ('fashion'), ('fashion');"
+        "INSERT INTO items (name, category_id, image_name) VALUES ('jacket', 1, 'a.jpg'), ('coat', 2, 'b.jpg');"
+    )
+    migrate(conn)
+    assert conn.execute("SELECT id, name FROM categories").fetchall() == [(1, "fashion")]
+    assert conn.execute("SELECT category_id FROM items").fetchall() == [(1,), (1,)]
+    # indexed in the migration that created items_fts, not in a separate step afterwards
+    assert conn.execute("SELECT rowid, name, category FROM items_fts ORDER BY rowid").fetchall() == [
+        (1, "jacket", "fashion"),
+        (2, "coat", "fashion"),
+    ]
+    with pytest.raises(sqlite3.IntegrityError):
+        conn.execute("INSERT INTO categories (name) VALUES ('fashion')")
+    conn.close()
+
+
+def query_plan(conn, sql, params):
+    return " | ".join(row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params))
+
+
+@pytest.mark.parametrize(
+    "sql, params, want",
+    [
+        (main.SELECT_CATEGORY_ID, ("fashion",), "USING COVERING INDEX categories_name (name=?)"),
+        (main.SELECT_ITEMS, (0, 10), "SEARCH categories USING INTEGER PRIMARY KEY (rowid=?)"),
+        (main.SELECT_ITEM_BY_ID, (1,), "SEARCH items USING INTEGER PRIMARY KEY (rowid=?)"),
+        # the category rename trigger looks items up by category
+        ("SELECT id FROM items WHERE category_id = ?", (1,), "USING COVERING INDEX items_category_id (category_id=?)"),
+        ("SELECT id FROM items WHERE name = ?", ("jacket",), "USING COVERING INDEX items_name (name=?)"),
+    ],
+)
+def test_query_plans_use_indexes(db_connection, sql, params, want):
+    plan = query_plan(db_connection, sql, params)
+    assert want in plan
+    assert "SCAN" not in plan.replace("SCAN items_fts", "")
+
+
+def test_suggest_ranks_completions_by_frequency(db_connection, image_dir):
+    seed_items(db_connection, ["jacket", "Jacket", "jacket", "jeans", "Jeans", "ジャケット", "ジャケット", "ジーンズ"])
+
+    response = client.get("/suggest", params={"prefix": "ja"})
+    assert response.json()["suggestions"] == [{"text": "jacket", "count": 3}]
+    # full-width input is folded like the names
+    words = [entry["text"] for entry in client.get("/suggest", params={"prefix": "Ｊ"}).json()["suggestions"]]
+    assert words == ["jacket", "jeans"]
+    words = [entry["text"] for entry in client.get("/suggest", params={"prefix": "ジ"}).json()["suggestions"]]
+    assert words == ["ジャケット", "ジーンズ"]
+    assert client.get("/suggest", params={"prefix": "f"}).json()["suggestions"] == [{"text": "fashion", "count": 8}]
+
+    # inserts through the writer are counted once they commit
+    with open(test_image, "rb") as f:
+        client.post("/items", data={"name": "jeans", "category": "denim"}, files={"image": ("default.jpg", f, "image/jpeg")})
+    assert client.get("/suggest", params={"prefix": "j", "limit": 1}).json()["suggestions"] == [{"text": "jacket", "count": 3}]
+    assert client.get("/suggest", params={"prefix": "jea"}).json()["suggestions"] == [{"text": "jeans", "count": 3}]
+    assert client.get("/stats").json()["suggestions"]["terms"] == 6
+
+
+def test_suggest_cached_tops_follow_inserts():
+    # a scan limit of 1 makes every prefix keep a cached top list
+    index = PrefixIndex(scan_limit=1, top_size=2)
+    index.add([("coat", 3), ("camera", 2), ("cap", 1)])
+    assert index.suggest("c") == [("coat", 3), ("camera", 2)]
+    index.add([("cap", 5)])
+    assert index.suggest("c") == [("cap", 6), ("coat", 3)]
+    index.add([("cup", 1), ("camera", 2)])
+    assert index.suggest("c") == [("cap", 6), ("camera", 4)]
+    assert index.suggest("ca") == [("cap", 6), ("camera", 4)]
+    assert index.stats()["memory_bytes"] > 0
+
+
+def test_suggest_snapshot(db_connection, tmp_path):
+    seed_items(db_connection, ["jacket", "jeans"])
+    index = PrefixIndex()
+    with test_pool.connection() as conn:
+        index.build(conn)
+        index.save(tmp_path / "suggest.json", conn)
+
+    seed_items(db_connection, ["jacket"])
+    restored = PrefixIndex()
+    with test_pool.connection() as conn:
+        assert restored.load(tmp_path / "suggest.json", conn)
+    # the snapshot plus the item committed after it
+    assert restored.suggest("j") == [("jacket", 2), ("jeans", 1)]
+    assert restored.watermark == 3
+
+    other = sqlite3.connect(tmp_path / "other.sqlite3")
+    migrate(other)
+    assert not PrefixIndex().load(tmp_path / "suggest.json", other)
+    assert not PrefixIndex().load(tmp_path / "missing.json", other)
+    other.close()
+
+
+def test_image_store_shards_and_migrates(image_dir):
+    store = main.image_store
+    flat = save_image(io.BytesIO(b"flat"), image_dir)
+    sharded = store.save(io.BytesIO(b"sharded"))
+    assert store.locate(sharded) == image_dir / sharded[:2] / sharded[2:4] / sharded
+    assert store.locate(flat) == image_dir / flat
+    assert store.locate("default.jpg") == image_dir / "default.jpg"
+    assert store.save(io.BytesIO(b"flat")) == flat  # found in the flat layout, not stored twice
+    assert client.get(f"/image/{flat}").content == b"flat"
+
+    assert migrate_store(store, batch_size=1, pause=0) == 1
+    assert store.locate(flat) == image_dir / flat[:2] / flat[2:4] / flat
+    assert sorted(name for name, _ in store.files()) == sorted([flat, sharded])
+    main.image_cache.clear()
+    assert client.get(f"/image/{flat}").content == b"flat"
+
+
+def test_image_gc_removes_unreferenced_images(db_connection, image_dir):
+    store = main.image_store
+    referenced = store.save(io.BytesIO(b"referenced"))
+    orphan = store.save(io.BytesIO(b"orphan"))
+    recent = store.save(io.BytesIO(b"upload still in flight"))
+    variant = store.path(variant_name(orphan, "thumb"))
+    variant.write_bytes(b"thumb")
+    db_connection.execute("INSERT INTO categories (name) VALUES ('fashion')")
+    db_connection.execute("INSERT INTO items (name, category_id, image_name) VALUES ('jacket', 1, ?)", (referenced,))
+    db_connection.commit()
+    for name in (referenced, orphan, variant_name(orphan, "thumb")):
+        os.utime(store.path(name), (0, 0))
+
+    removed = []
+    stats = collect_garbage(store, test_pool, grace=60, batch_size=2, pause=0, on_remove=removed.append)
+    assert sorted(removed) == sorted([orphan, variant_name(orphan, "thumb")])
+    assert (stats["checked"], stats["too_recent"]) == (4, 1)
+    assert store.locate(referenced) and store.locate(recent) and store.locate("default.jpg")
+    assert store.locate(orphan) is None
+    assert sorted(path.name for path in store.path(recent).parent.iterdir()) == [recent]
+
+
+def test_image_gc_skips_empty_database(image_dir):
+    store = main.image_store
+    orphan = store.save(io.BytesIO(b"orphan"))
+    os.utime(store.path(orphan), (0, 0))
+
+    assert collect_garbage(store, test_pool, grace=60, pause=0)["checked"] == 0
+    assert store.locate(orphan) is not None
+
+
+def test_image_integrity_scan_quarantines_corrupt_files(image_dir):
+    store = main.image_store
+    good = store.save(io.BytesIO(b"good"))
+    bad = store.save(io.BytesIO(b"bad"))
+    store.path(bad).write_bytes(b"bit rot")
+
+    stats = scan_integrity(store, workers=2, bytes_per_second=0)
+    assert stats["scanned"] == 2
+    assert stats["corrupt"] == [bad]
+    assert store.locate(bad) is None and store.locate(good) is not None
+    assert (image_dir / ".corrupt" / bad).read_bytes() == b"bit rot"
+
+
+def test_health_endpoints(monkeypatch):
+    assert client.get("/livez").json() == {"status": "ok"}
+    monkeypatch.setattr(main, "ready", main.threading.Event())
+    assert client.get("/readyz").status_code == 503
+    main.ready.set()
+    assert client.get("/readyz").json() == {"status": "ready"}
+
+
+@pytest.mark.parametrize("header, want", [
+    (None, None),
+    ("identity", None),
+    ("gzip, deflate", "gzip"),
+    ("GZIP;q=0.5", "gzip"),
+    ("gzip;q=0", None),
+    ("*", "gzip"),
+])
+def test_negotiate_encoding(header, want, monkeypatch):
+    monkeypatch.setattr("compression.brotli", None)
+    assert negotiate(header) == want
+
+
+def test_cached_responses_are_compressed_once(db_connection, monkeypatch):
+    monkeypatch.setattr("compression.brotli", None)
+    seed_items(db_connection, [f"jacket {i}" for i in range(50)])
+
+    plain = client.get("/items", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in plain.headers
+    for want_cache in ("HIT", "HIT"):
+        # the plain body is cached already; the gzipped one is made on the first request only
+        response = client.get("/items", headers={"Accept-Encoding": "gzip"})
+        assert response.headers["content-encoding"] == "gzip"
+        assert response.headers["x-cache"] == want_cache
+        assert response.content == plain.content
+    assert main.response_cache.stats()["entries"] == 2
+
+
+def test_shared_catalogue_version(tmp_path):
+    first = SharedCatalogueVersion(tmp_path / "version")
+    second = SharedCatalogueVersion(tmp_path / "version")
+    assert first.value == second.value == 0
+    assert first.bump() == 1
+    assert second.bump() == 2
+    assert first.value == 2
+
+
+def test_suggest_sees_rows_committed_by_other_workers(db_connection):
+    seed_items(db_connection, ["jacket"])
+    assert client.get("/suggest", params={"prefix": "ja"}).json()["suggestions"] == [{"text": "jacket", "count": 1}]
+    # another process committed: only the shared version tells this one about it
+    db_connection.execute("INSERT INTO items (name, category_id, image_name) VALUES ('jacket', 1, 'default.jpg')")
+    db_connection.commit()
+    main.catalogue_version.bump()
+    assert client.get("/suggest", params={"prefix": "ja"}).json()["suggestions"] == [{"text": "jacket", "count": 2}]
+
+
+def test_available_cpus_honours_cgroup_quota(tmp_path):
+    affinity = available_cpus(tmp_path)  # no cgroup files: the affinity mask alone
+    (tmp_path / "cpu.max").write_text("100000 100000\n")
+    assert available_cpus(tmp_path) == 1
+    (tmp_path / "cpu.max").write_text("max 100000\n")
+    assert available_cpus(tmp_path) == affinity
+
+
+def test_image_removals_elsewhere_clear_the_image_cache(image_dir):
+    client.get("/image/default.jpg")
+    misses = main.image_cache.stats()["misses"]
+    client.get("/image/default.jpg")
+    assert main.image_cache.stats()["misses"] == misses
+    # maintenance in another process removed something: which image is unknown here
+    main.image_removals.bump()
+    client.get("/image/default.jpg")
+    assert main.image_cache.stats()["misses"] == misses + 1
@@ -0,0 +1,311 @@
+# Background upkeep of the image store, also runnable by hand:
+#
+#   python maintenance.py migrate        # move flat-layout images into their shards
+#   python maintenance.py gc             # delete images no item references
+#   python maintenance.py scan           # re-hash every original and quarantine corrupt ones
+import os
+import sys
+import time
+import hashlib
+import logging
+import pathlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from database import COUNT_IMAGE_REFERENCES, ConnectionPool
+from storage import UPLOAD_CHUNK_SIZE, ImageStore
+
+logger = logging.getLogger("uvicorn")
+
+# seconds between runs; 0 disables the task. GC is opt-in: it deletes every image the
+# database at DB_PATH does not reference, so it must only run against the images
+# directory that belongs to that database
+IMAGE_GC_INTERVAL = float(os.environ.get("IMAGE_GC_INTERVAL", "0"))
+IMAGE_SCAN_INTERVAL = float(os.environ.get("IMAGE_SCAN_INTERVAL", str(24 * 3600)))
+# files modified more recently than this are never collected: their item may not have committed yet
+IMAGE_GC_GRACE = float(os.environ.get("IMAGE_GC_GRACE", "3600"))
+# files handled per step, with a pause after each step so the disk and database stay free for requests
+IMAGE_MAINTENANCE_BATCH = int(os.environ.get("IMAGE_MAINTENANCE_BATCH", "500"))
+IMAGE_MAINTENANCE_PAUSE = float(os.environ.get("IMAGE_MAINTENANCE_PAUSE", "0.05"))
+IMAGE_SCAN_WORKERS = int(os.environ.get("IMAGE_SCAN_WORKERS", "2"))
+# total read rate of the integrity scan across its workers; 0 is unthrottled
+IMAGE_SCAN_BYTES_PER_SECOND = int(os.environ.get("IMAGE_SCAN_BYTES_PER_SECOND", str(32 * 1024 * 1024)))
+
+QUARANTINE_DIR = ".corrupt"
+# files are renamed to this prefix before they are deleted; STORED_NAME never matches it
+GC_PREFIX = ".gc-"
+
+
+def original_name(name: str) -> str:
+    # <sha256>_thumb.jpg -> <sha256>.jpg
+    return name[:64] + ".jpg"
+
+
+def batches(files: Iterable[Tuple[str, pathlib.Path]], size: int) -> Iterable[List[Tuple[str, pathlib.Path]]]:
+    batch = []
+    for entry in files:
+        batch.append(entry)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def has_items(pool: ConnectionPool) -> bool:
+    with pool.connection() as conn:
+        return conn.execute("SELECT EXISTS (SELECT 1 FROM items)").fetchone()[0] == 1
+
+
+def count_references(pool: ConnectionPool, names: Set[str]) -> Dict[str, int]:
+    query = COUNT_IMAGE_REFERENCES.format(",".join("?" * len(names)))
+    with pool.connection() as conn:
+        return {name: count for name, count in conn.execute(query, tuple(names))}
+
+
+def collect_garbage(
+    store: ImageStore,
+    pool: ConnectionPool,
+    grace: float = IMAGE_GC_GRACE,
+    batch_size: int = IMAGE_MAINTENANCE_BATCH,
+    pause: float = IMAGE_MAINTENANCE_PAUSE,
+    on_remove: Optional[Callable[[str], None]] = None,
+    stop: Optional[threading.Event] = None,
+) -> Dict[str, int]:
+    """Delete stored images, and their variants, that no item references.
+
+    Reference counts come from items.image_name a batch at a time, so memory
+    stays flat however many files there are. Nothing is collected while the
+    items table is empty: that is a fresh or mismatched database, not one whose
+    items were all deleted.
+    """
+    stats = {"checked": 0, "removed": 0, "removed_bytes": 0, "too_recent": 0}
+    if not has_items(pool):
+        logger.warning("Image GC skipped: the items table is empty, so %s may belong to another database", store.root)
+        return stats
+    for batch in batches(store.files(), batch_size):
+        if stop is not None and stop.is_set():
+            break
+        references = count_references(pool, {original_name(name) for name, _ in batch})
+        cutoff = time.time() - grace
+        for name, path in batch:
+            stats["checked"] += 1
+            if references.get(original_name(name)):
+                continue
+            # rename first, then check the mtime: an upload that touched the file before the
+            # rename is seen here, and one after it no longer finds the file and stores it again
+            doomed = path.with_name(GC_PREFIX + name)
+            try:
+                os.rename(path, doomed)
+                status = doomed.stat()
+                if status.st_mtime > cutoff:
+                    os.replace(doomed, path)
+                    stats["too_recent"] += 1
+                    continue
+                doomed.unlink()
+            except FileNotFoundError:
+                continue
+            stats["removed"] += 1
+            stats["removed_bytes"] += status.st_size
+            if on_remove is not None:
+                on_remove(name)
+        if pause:
+            time.sleep(pause)
+    if stats["removed"]:
+        logger.info("Image GC removed %s unreferenced files (%s bytes)", stats["removed"], stats["removed_bytes"])
+    return stats
+
+
+class RateLimiter:
+    """A token bucket shared by threads: acquire(n) blocks until n more bytes fit in the rate."""
+
+    def __init__(self, rate: float, stop: Optional[threading.Event] = None):
+        self.rate = rate
+        self.stop = stop or threading.Event()
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount: int):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next, now)
+            self._next = start + amount / self.rate
+        if start > now:
+            self.stop.wait(start - now)
+
+
+def verify_image(path: pathlib.Path, name: str, limiter: RateLimiter, chunk_size: int = UPLOAD_CHUNK_SIZE) -> bool:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            limiter.acquire(len(chunk))
+            digest.update(chunk)
+    return digest.hexdigest() == name[:64]
+
+
+def scan_integrity(
+    store: ImageStore,
+    workers: int = IMAGE_SCAN_WORKERS,
+    bytes_per_second: float = IMAGE_SCAN_BYTES_PER_SECOND,
+    on_corrupt: Optional[Callable[[str], None]] = None,
+    stop: Optional[threading.Event] = None,
+) -> Dict[str, Any]:
+    """Re-hash every stored original and quarantine the ones whose content no longer matches their name.
+
+    Variants are named after their original rather than their own bytes, so
+    they are not checked; they can always be rendered again.
+    """
+    stop = stop or threading.Event()
+    limiter = RateLimiter(bytes_per_second, stop)
+    stats: Dict[str, Any] = {"scanned": 0, "bytes": 0, "corrupt": []}
+    quarantine = store.root / QUARANTINE_DIR
+
+    def check(entry: Tuple[str, pathlib.Path]):
+        name, path = entry
+        try:
+            return name, path, verify_image(path, name, limiter), path.stat().st_size
+        except FileNotFoundError:  # collected or migrated while queued
+            return name, path, True, 0
+
+    originals = ((name, path) for name, path in store.files() if "_" not in name)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # a few batches in flight at a time, rather than a future for every file
+        for batch in batches(originals, workers * 16):
+            if stop.is_set():
+                break
+            for name, path, intact, size in executor.map(check, batch):
+                stats["scanned"] += 1
+                stats["bytes"] += size
+                if intact:
+                    continue
+                quarantine.mkdir(exist_ok=True)
+                os.replace(path, quarantine / name)
+                stats["corrupt"].append(name)
+                logger.error("Image %s does not match its hash, moved to %s", name, quarantine)
+                if on_corrupt is not None:
+                    on_corrupt(name)
+    return stats
+
+
+def migrate_store(
+    store: ImageStore,
+    batch_size: int = IMAGE_MAINTENANCE_BATCH,
+    pause: float = IMAGE_MAINTENANCE_PAUSE,
+    stop: Optional[threading.Event] = None,
+) -> int:
+    # the flat layout keeps working throughout, so this can run while serving
+    moved = 0
+    while stop is None or not stop.is_set():
+        step = store.migrate(limit=batch_size)
+        moved += step
+        if step < batch_size:
+            break
+        time.sleep(pause)
+    if moved:
+        logger.info("Moved %s images into the sharded layout", moved)
+    return moved
+
+
+class ImageMaintenance:
+    """Runs the layout migration once, then garbage collection and the integrity scan on their intervals, in a background thread."""
+
+    def __init__(
+        self,
+        store: ImageStore,
+        pool: ConnectionPool,
+        gc_interval: float = IMAGE_GC_INTERVAL,
+        scan_interval: float = IMAGE_SCAN_INTERVAL,
+        on_remove: Optional[Callable[[str], None]] = None,
+    ):
+        self.store = store
+        self.pool = pool
+        self.gc_interval = gc_interval
+        self.scan_interval = scan_interval
+        # called with the name of every file removed or quarantined, e.g. to evict caches
+        self.on_remove = on_remove
+        self.last_run: Dict[str, Any] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="image-maintenance", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        self._task("migrate", lambda: {"moved": migrate_store(self.store, stop=self._stop)})
+        now = time.monotonic()
+        due = {"gc": now + self.gc_interval, "scan": now + self.scan_interval}
+        tasks = {
+            "gc": (self.gc_interval, lambda: collect_garbage(self.store, self.pool, on_remove=self.on_remove, stop=self._stop)),
+            "scan": (self.scan_interval, lambda: scan_integrity(self.store, on_corrupt=self.on_remove, stop=self._stop)),
+        }
+        tasks = {name: task for name, task in tasks.items() if task[0] > 0}
+        while tasks and not self._stop.wait(max(0.0, min(due[name] for name in tasks) - time.monotonic())):
+            for name, (interval, run) in tasks.items():
+                if due[name] <= time.monotonic():
+                    self._task(name, run)
+                    due[name] = time.monotonic() + interval
+
+    def _task(self, name: str, run: Callable[[], Dict[str, Any]]):
+        start = time.monotonic()
+        try:
+            result = run()
+        except Exception as e:
+            logger.error(f"Image {name} failed: {e}")
+            result = {"error": str(e)}
+        result["seconds"] = time.monotonic() - start
+        result["finished_at"] = time.time()
+        self.last_run[name] = result
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            name: {key: len(value) if isinstance(value, list) else value for key, value in result.items()}
+            for name, result in self.last_run.items()
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Image store maintenance")
+    parser.add_argument("task", choices=["migrate", "gc", "scan"])
+    parser.add_argument("--db", type=pathlib.Path, default=None, help="database file (defaults to mercari.sqlite3)")
+    parser.add_argument("--images", type=pathlib.Path, default=None, help="image directory (defaults to images/)")
+    parser.add_argument("--grace", type=float, default=IMAGE_GC_GRACE, help="seconds a new file is safe from gc")
+    parser.add_argument("--workers", type=int, default=IMAGE_SCAN_WORKERS)
+    parser.add_argument("--rate", type=int, default=IMAGE_SCAN_BYTES_PER_SECOND, help="scan bytes per second, 0 for no limit")
+    args = parser.parse_args()
+
+    import main as app_module
+
+    store = ImageStore(args.images or app_module.images)
+    if args.task == "migrate":
+        print(f"moved {migrate_store(store, pause=0)} images")
+        return 0
+    if args.task == "scan":
+        result = scan_integrity(store, args.workers, args.rate)
+        print(f"scanned {result['scanned']} images ({result['bytes']} bytes), {len(result['corrupt'])} corrupt")
+        for name in result["corrupt"]:
+            print(f"corrupt: {name}", file=sys.stderr)
+        return 1 if result["corrupt"] else 0
+    path = args.db or app_module.db
+    app_module.setup_database(path)
+    pool = ConnectionPool(path, size=1)
+    result = collect_garbage(store, pool, grace=args.grace, pause=0)
+    pool.close()
+    print(f"checked {result['checked']} files, removed {result['removed']} ({result['removed_bytes']} bytes)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,265 @@
+import os
+import json
+import bisect
+import logging
+import pathlib
+import tempfile
+import threading
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger("uvicorn")
+
+# seconds between the snapshots each worker writes for the others (see WorkerSnapshots)
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", "5"))
+
+# seconds; covers sub-millisecond cache hits up to multi-second exports
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _format_labels(labels: Labels, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def snapshot(self) -> List:
+        with self._lock:
+            return [[labels, value] for labels, value in self._values.items()]
+
+    def merge(self, values: List):
+        # adds another process's snapshot to this one
+        with self._lock:
+            for labels, value in values:
+                key = tuple(tuple(pair) for pair in labels)
+                self._values[key] = self._values.get(key, 0) + value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts..., +Inf count], sum
+        self._values: Dict[Labels, Tuple[List[int], List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            entry[0][index] += 1
+            entry[1][0] += value
+
+    def count(self, **labels: str) -> int:
+        entry = self._values.get(tuple(sorted(labels.items())))
+        return sum(entry[0]) if entry else 0
+
+    def snapshot(self) -> List:
+        with self._lock:
+            return [[labels, counts[:], total[0]] for labels, (counts, total) in self._values.items()]
+
+    def merge(self, values: List):
+        with self._lock:
+            for labels, counts, total in values:
+                key = tuple(tuple(pair) for pair in labels)
+                entry = self._values.get(key)
+                if entry is None:
+                    entry = self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+                for index, count in enumerate(counts):
+                    entry[0][index] += count
+                entry[1][0] += total
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = (("le", _format_value(bound)),)
+                    lines.append(f"{self.name}_bucket{_format_labels(labels, le)} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(total[0])}")
+                lines.append(f"{self.name}_count{_format_labels(labels)} {cumulative}")
+        return lines
+
+
+def render_gauges(name: str, help: str, values: Dict[str, float], label: str) -> List[str]:
+    # one gauge family from a stats() dict, e.g. {"hits": 3} -> name{label="hits"} 3
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} gauge"]
+    for key, value in sorted(values.items()):
+        lines.append(f"{name}{_format_labels(((label, key),))} {_format_value(value)}")
+    return lines
+
+
+def render_worker_gauges(name: str, help: str, values: Dict[int, Dict[str, float]], label: str) -> List[str]:
+    # like render_gauges, with one series per worker process, e.g. name{label="hits",worker="12"} 3
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} gauge"]
+    for pid, stats in sorted(values.items()):
+        for key, value in sorted(stats.items()):
+            lines.append(f"{name}{_format_labels(((label, key), ('worker', str(pid))))} {_format_value(value)}")
+    return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name: str, help: str) -> Counter:
+        metric = Counter(name, help)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help: str, buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, help, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> List[str]:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return lines
+
+    def snapshot(self) -> Dict[str, List]:
+        return {metric.name: metric.snapshot() for metric in self.metrics}
+
+    def merged(self, snapshots: List[Dict[str, List]]) -> "Registry":
+        # a registry with the same metrics holding the sum of several processes' snapshots
+        total = Registry()
+        for metric in self.metrics:
+            if isinstance(metric, Histogram):
+                copy = total.histogram(metric.name, metric.help, metric.buckets)
+            else:
+                copy = total.counter(metric.name, metric.help)
+            for snapshot in snapshots:
+                copy.merge(snapshot.get(metric.name, []))
+        return total
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class WorkerSnapshots:
+    """Shares every worker process's metrics and stats through snapshot files in one directory.
+
+    Each worker rewrites worker-<pid>.json every METRICS_FLUSH_INTERVAL seconds,
+    and once more when it is scraped, so whichever worker answers /metrics can
+    report all of them. Other workers' numbers are up to one interval old.
+    """
+
+    def __init__(
+        self,
+        directory: pathlib.Path,
+        registry: "Registry",
+        state: Callable[[], Dict[str, Any]],
+        interval: float = METRICS_FLUSH_INTERVAL,
+    ):
+        self.directory = pathlib.Path(directory)
+        self.registry = registry
+        # this worker's gauges and stats, anything json.dumps can encode
+        self.state = state
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def write(self):
+        snapshot = {"pid": os.getpid(), "metrics": self.registry.snapshot(), "state": self.state()}
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".worker-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as out:
+                json.dump(snapshot, out, default=str)
+            os.replace(tmp_path, self.directory / f"worker-{os.getpid()}.json")
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    def collect(self) -> List[Dict[str, Any]]:
+        """Every worker's latest snapshot, this one's current. Workers that have exited are
+        kept so their counters still add up, but are marked as not alive."""
+        self.write()
+        snapshots = []
+        for path in sorted(self.directory.glob("worker-*.json")):
+            try:
+                snapshot = json.loads(path.read_text())
+            except (OSError, ValueError):  # removed, or from a worker that died mid-write
+                continue
+            snapshot["alive"] = _alive(snapshot["pid"])
+            snapshots.append(snapshot)
+        return snapshots
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="metrics-snapshots", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        # the final counts of a worker that shuts down cleanly are not lost
+        self._write_logged()
+
+    def _run(self):
+        while True:
+            self._write_logged()
+            if self._stop.wait(self.interval):
+                break
+
+    def _write_logged(self):
+        try:
+            self.write()
+        except Exception as e:
+            logger.error(f"Could not write the metrics snapshot: {e}")
+
+
+registry = Registry()
+
+http_request_seconds = registry.histogram("http_request_duration_seconds", "HTTP request latency by route and status")
+sql_query_seconds = registry.histogram("sql_query_duration_seconds", "Time spent executing SQL statements")
+sql_fetch_seconds = registry.counter("sql_fetch_seconds_total", "Time spent fetching SQL result rows")
+sql_rows = registry.counter("sql_rows_fetched_total", "Rows fetched from SQL queries")
+sql_slow_queries = registry.counter("sql_slow_queries_total", "SQL statements slower than the slow query threshold")
@@ -0,0 +1,103 @@
+import time
+from typing import Dict, Optional
+
+from starlette.exceptions import HTTPException
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from metrics import Histogram
+
+
+# an HTTPException so FastAPI's body parsing lets it through as a 413
+class RequestTooLarge(HTTPException):
+    def __init__(self, max_body_size: int):
+        super().__init__(status_code=413, detail=f"Request body is larger than {max_body_size} bytes")
+
+
+class BodySizeLimitMiddleware:
+    """Rejects request bodies over max_body_size with 413 before they are parsed.
+
+    A Content-Length over the limit is refused without reading the body. For
+    chunked bodies the bytes are counted as they arrive and the request is
+    aborted as soon as the limit is crossed.
+    """
+
+    def __init__(self, app: ASGIApp, max_body_size: int, path_limits: Optional[Dict[str, int]] = None):
+        self.app = app
+        self.max_body_size = max_body_size
+        # exact paths that accept a different limit, e.g. bulk uploads
+        self.path_limits = path_limits or {}
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        max_body_size = self.path_limits.get(scope["path"], self.max_body_size)
+
+        for name, value in scope["headers"]:
+            if name == b"content-length":
+                try:
+                    too_large = int(value) > max_body_size
+                except ValueError:
+                    too_large = False
+                if too_large:
+                    await self._reject(scope, receive, send, max_body_size)
+                    return
+
+        received = 0
+        response_started = False
+
+        async def limited_receive() -> Message:
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > max_body_size:
+                    raise RequestTooLarge(max_body_size)
+            return message
+
+        async def tracking_send(message: Message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, tracking_send)
+        except RequestTooLarge:
+            if response_started:
+                raise
+            await self._reject(scope, receive, send, max_body_size)
+
+    async def _reject(self, scope: Scope, receive: Receive, send: Send, max_body_size: int):
+        response = JSONResponse({"detail": f"Request body is larger than {max_body_size} bytes"}, status_code=413)
+        await response(scope, receive, send)
+
+
+class MetricsMiddleware:
+    """Records request latency per route template and status code."""
+
+    def __init__(self, app: ASGIApp, histogram: Histogram):
+        self.app = app
+        self.histogram = histogram
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        start = time.perf_counter()
+
+        async def recording_send(message: Message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, recording_send)
+        finally:
+            # label by the matched route template (/items/{item_id}), never the raw path
+            route = getattr(scope.get("route"), "path", "unmatched")
+            self.histogram.observe(time.perf_counter() - start, method=scope["method"], route=route, status=str(status))
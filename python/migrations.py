@@ -0,0 +1,86 @@
+import re
+import sqlite3
+import logging
+import pathlib
+from typing import List, NamedTuple, Optional
+
+logger = logging.getLogger("uvicorn")
+
+MIGRATIONS_DIR = pathlib.Path(__file__).parent.resolve() / "db" / "migrations"
+
+# db/migrations/0002_indexes.sql -> version 2
+MIGRATION_FILE = re.compile(r"^(\d+)_(\w+)\.sql$")
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    path: pathlib.Path
+
+
+def discover(directory: pathlib.Path = MIGRATIONS_DIR) -> List[Migration]:
+    migrations = []
+    for path in directory.iterdir():
+        match = MIGRATION_FILE.match(path.name)
+        if match:
+            migrations.append(Migration(int(match.group(1)), match.group(2), path))
+    migrations.sort()
+    for expected, migration in enumerate(migrations, start=1):
+        if migration.version != expected:
+            raise RuntimeError(f"Migration versions must run 1, 2, 3...: found {migration.path.name} at {expected}")
+    return migrations
+
+
+def schema_version(conn: sqlite3.Connection) -> int:
+    # the applied version lives in the database header, so checking it is one read
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def split_statements(script: str) -> List[str]:
+    # line-wise so trigger bodies (BEGIN ... END;) stay in one statement
+    statements, current = [], ""
+    for line in script.splitlines(keepends=True):
+        current += line
+        if sqlite3.complete_statement(current):
+            statements.append(current.strip())
+            current = ""
+    leftover = [line for line in current.splitlines() if line.strip() and not line.strip().startswith("--")]
+    if leftover:
+        raise RuntimeError(f"Incomplete SQL statement at the end of the migration: {leftover[0]}")
+    return statements
+
+
+def migrate(conn: sqlite3.Connection, directory: Optional[pathlib.Path] = None) -> List[Migration]:
+    """Apply the migrations newer than the database's schema version.
+
+    Each migration runs in its own IMMEDIATE transaction together with the
+    version bump, so a failed migration leaves the database at the previous
+    version and concurrent starters apply each migration once.
+    """
+    migrations = discover(directory or MIGRATIONS_DIR)
+    if schema_version(conn) >= len(migrations):
+        return []
+
+    applied = []
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None  # transactions are managed explicitly below
+    try:
+        for migration in migrations:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # re-read under the write lock in case another process got here first
+                if schema_version(conn) >= migration.version:
+                    conn.execute("COMMIT")
+                    continue
+                for statement in split_statements(migration.path.read_text()):
+                    conn.execute(statement)
+                conn.execute(f"PRAGMA user_version = {migration.version}")
+                conn.execute("COMMIT")
+            except Exception as e:
+                conn.execute("ROLLBACK")
+                raise RuntimeError(f"Migration {migration.path.name} failed: {e}")
+            logger.info("Applied migration %s", migration.path.name)
+            applied.append(migration)
+    finally:
+        conn.isolation_level = isolation_level
+    return applied
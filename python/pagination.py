@@ -0,0 +1,138 @@
+import os
+import json
+import math
+import base64
+import binascii
+from typing import Callable, Dict, Iterator, List, Literal, Optional, Sequence, Tuple
+
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+
+from database import ConnectionPool
+
+try:
+    import orjson
+except ImportError:  # the standard library encoder is used instead
+    orjson = None
+
+DEFAULT_PAGE_SIZE = int(os.environ.get("PAGE_SIZE", "100"))
+MAX_PAGE_SIZE = int(os.environ.get("MAX_PAGE_SIZE", "1000"))
+# rows pulled from the cursor per streamed chunk
+STREAM_CHUNK_SIZE = int(os.environ.get("STREAM_CHUNK_SIZE", "500"))
+
+StreamFormat = Literal["ndjson", "json"]
+
+STREAM_MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "json": "application/json",
+}
+
+
+def dumps(value) -> bytes:
+    # compact UTF-8 JSON; orjson, when installed, encodes a 1000-item page about 10x faster
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+# SQLite's INTEGER range; a larger id would overflow when bound as a parameter
+MAX_ITEM_ID = 2**63 - 1
+
+
+# Cursors are the last seen sort key, base64url encoded so clients treat them as opaque
+def _encode(payload: str) -> str:
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def _decode(cursor: str) -> str:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        return base64.urlsafe_b64decode(padded).decode()
+    except (ValueError, binascii.Error, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail=f"Invalid cursor: {cursor}")
+
+
+def encode_cursor(item_id: int) -> str:
+    return _encode(str(item_id))
+
+
+def decode_cursor(cursor: Optional[str]) -> int:
+    if not cursor:
+        return 0
+    try:
+        item_id = int(_decode(cursor))
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid cursor: {cursor}")
+    if not 0 <= item_id <= MAX_ITEM_ID:
+        raise HTTPException(status_code=400, detail=f"Invalid cursor: {cursor}")
+    return item_id
+
+
+# Ranked results page on (score, id); repr() round-trips the float exactly
+def encode_rank_cursor(score: float, item_id: int) -> str:
+    return _encode(f"{score!r}:{item_id}")
+
+
+def decode_rank_cursor(cursor: Optional[str]) -> Tuple[float, int]:
+    if not cursor:
+        return float("-inf"), 0
+    try:
+        score, item_id = _decode(cursor).split(":")
+        score, item_id = float(score), int(item_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid cursor: {cursor}")
+    if math.isnan(score) or not 0 <= item_id <= MAX_ITEM_ID:
+        raise HTTPException(status_code=400, detail=f"Invalid cursor: {cursor}")
+    return score, item_id
+
+
+# rows are (id, name, category, image_name) in that order
+def row_to_item(row: Sequence) -> Dict:
+    return {"id": row[0], "name": row[1], "category": row[2], "image_name": row[3]}
+
+
+def build_page(
+    rows: List[Sequence],
+    limit: int,
+    cursor_of: Callable[[Sequence], str] = lambda row: encode_cursor(row[0]),
+) -> Dict:
+    # the query fetches limit + 1 rows so we know whether another page exists
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = cursor_of(rows[-1]) if has_more else None
+    return {"items": [row_to_item(row) for row in rows], "next_cursor": next_cursor}
+
+
+def _stream_rows(pool: ConnectionPool, query: str, params: tuple, fmt: StreamFormat) -> Iterator[bytes]:
+    # an export holds its connection, and its read transaction, for as long as the
+    # client takes to download it, so it gets its own instead of starving the pool.
+    # It is opened on the first chunk and closed when the response finishes or the
+    # client goes away
+    conn = pool.connect()
+    try:
+        cursor = conn.execute(query, params)
+        try:
+            if fmt == "json":
+                yield b'{"items":['
+            first = True
+            while True:
+                rows = cursor.fetchmany(STREAM_CHUNK_SIZE)
+                if not rows:
+                    break
+                if fmt == "ndjson":
+                    yield b"\n".join(dumps(row_to_item(row)) for row in rows) + b"\n"
+                else:
+                    # the chunk as one JSON array, without its brackets
+                    chunk = dumps([row_to_item(row) for row in rows])[1:-1]
+                    yield chunk if first else b"," + chunk
+                first = False
+            if fmt == "json":
+                yield b"]}"
+        finally:
+            cursor.close()
+    finally:
+        conn.close()
+
+
+def stream_query(pool: ConnectionPool, query: str, params: tuple, fmt: StreamFormat) -> StreamingResponse:
+    return StreamingResponse(_stream_rows(pool, query, params, fmt), media_type=STREAM_MEDIA_TYPES[fmt])
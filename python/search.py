@@ -0,0 +1,41 @@
+import sqlite3
+from typing import Callable, Literal, Optional, Sequence, Tuple
+
+from database import (
+    SEARCH_ITEMS,
+    SEARCH_ITEMS_FTS,
+    SEARCH_ITEMS_RANKED,
+    BACKFILL_ITEMS_FTS,
+)
+from pagination import decode_cursor, decode_rank_cursor, encode_cursor, encode_rank_cursor
+
+# the trigram tokenizer cannot match anything shorter than one trigram
+MIN_FTS_KEYWORD_LENGTH = 3
+
+SearchSort = Literal["id", "relevance"]
+
+
+def backfill_search_index(conn: sqlite3.Connection):
+    # rebuilds items_fts from scratch, e.g. after restoring a damaged index; new
+    # databases are indexed by db/migrations/0001_initial.sql and its triggers
+    conn.execute("DELETE FROM items_fts")
+    conn.execute(BACKFILL_ITEMS_FTS)
+
+
+def fts_phrase(keyword: str) -> str:
+    # quote the keyword as a single FTS5 phrase so operators in user input are literal
+    return '"' + keyword.replace('"', '""') + '"'
+
+
+# Returns the query, its parameters (without the trailing LIMIT) and how to
+# turn the last row of a page into a cursor for the next one.
+def plan_search(
+    keyword: str, sort: SearchSort, after: Optional[str]
+) -> Tuple[str, tuple, Callable[[Sequence], str]]:
+    if len(keyword) < MIN_FTS_KEYWORD_LENGTH:
+        pattern = f"%{keyword}%"
+        return SEARCH_ITEMS, (pattern, pattern, decode_cursor(after)), lambda row: encode_cursor(row[0])
+    if sort == "relevance":
+        score, item_id = decode_rank_cursor(after)
+        return SEARCH_ITEMS_RANKED, (fts_phrase(keyword), score, item_id), lambda row: encode_rank_cursor(row[4], row[0])
+    return SEARCH_ITEMS_FTS, (fts_phrase(keyword), decode_cursor(after)), lambda row: encode_cursor(row[0])
@@ -0,0 +1,113 @@
+# Production entry point: several worker processes, no reload.
+#
+#   python serve.py                      # one worker per available CPU (at most WORKERS_MAX) on 0.0.0.0:9000
+#   python serve.py --workers 4 --port 9001
+#
+# The database is migrated, the suggestion snapshot written and image maintenance
+# started here, once, before the workers start; each worker then only opens its
+# pool and loads the snapshot. Workers share the catalogue version through a
+# memory-mapped file, so a write in one retires the cached responses of all, and
+# a removal counter, so images maintenance deletes or quarantines leave every
+# worker's image cache. They also write metrics snapshots into METRICS_DIR, so
+# /metrics (counters summed, gauges labelled by worker pid) and /stats (under
+# "workers") cover every worker whichever one answers the scrape.
+# uvicorn picks uvloop and httptools when they are installed (uvicorn[standard]).
+import os
+import sys
+import math
+import shutil
+import tempfile
+import pathlib
+import argparse
+import logging
+
+logger = logging.getLogger("uvicorn")
+
+CGROUP_ROOT = pathlib.Path("/sys/fs/cgroup")
+
+
+def available_cpus(cgroup_root: pathlib.Path = CGROUP_ROOT) -> int:
+    # os.cpu_count() is the host's count even inside a container; this honours the
+    # CPU affinity mask and a cgroup CPU quota (docker --cpus), v2 or v1
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:  # not on Linux
+        cpus = os.cpu_count() or 1
+    for quota_file, period_file in (("cpu.max", None), ("cpu/cpu.cfs_quota_us", "cpu/cpu.cfs_period_us")):
+        try:
+            values = (cgroup_root / quota_file).read_text().split()
+            if period_file is not None:
+                values.append((cgroup_root / period_file).read_text().strip())
+            quota, period = values[0], values[1]
+        except (OSError, IndexError):
+            continue
+        if quota not in ("max", "-1"):
+            cpus = min(cpus, max(1, math.ceil(int(quota) / int(period))))
+        break
+    return cpus
+
+
+# every worker holds its own response and image caches, suggestion index and
+# render processes, so the default count is capped to keep memory bounded
+WORKERS_MAX = int(os.environ.get("WORKERS_MAX", "8"))
+WORKERS = int(os.environ.get("WORKERS", "0")) or min(available_cpus(), WORKERS_MAX)
+HOST = os.environ.get("HOST", "0.0.0.0")
+PORT = int(os.environ.get("PORT", "9000"))
+
+
+def prepare():
+    import main
+
+    main.setup_database()
+    # workers start from this snapshot instead of each scanning the items table
+    main.load_suggestions(main.db_pool)
+    main.save_suggestions(main.db_pool)
+    main.image_maintenance.start()
+    return main
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the API with several worker processes")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="worker processes (defaults to the available CPUs, at most WORKERS_MAX)")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--log-level", default=os.environ.get("LOG_LEVEL", "info").lower())
+    args = parser.parse_args(argv)
+
+    try:
+        import uvicorn
+    except ImportError:
+        print("serve.py needs uvicorn: pip install -r requirements.txt", file=sys.stderr)
+        return 1
+
+    # read by main at import time, here and in every worker (they inherit the environment)
+    os.environ["DB_PREPARED"] = "1"
+    os.environ["IMAGE_MAINTENANCE"] = "0"
+    os.environ["SHARED_CATALOGUE_VERSION"] = "1"
+    os.environ["LOG_LEVEL"] = args.log_level.upper()
+    # a fresh directory, so snapshots of an earlier run are not counted
+    metrics_dir = tempfile.mkdtemp(prefix="mercari-metrics-")
+    os.environ["METRICS_DIR"] = metrics_dir
+
+    app_module = prepare()
+    try:
+        uvicorn.run(
+            "main:app",
+            host=args.host,
+            port=args.port,
+            workers=args.workers,
+            loop="auto",
+            http="auto",
+            reload=False,
+            access_log=False,
+            log_level=args.log_level,
+        )
+    finally:
+        app_module.image_maintenance.stop()
+        app_module.db_pool.close()
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,173 @@
+import os
+import re
+import hashlib
+import pathlib
+import tempfile
+from typing import BinaryIO, Iterator, Optional, Tuple
+
+# Uploads are read this many bytes at a time and rejected once they pass the maximum
+UPLOAD_CHUNK_SIZE = int(os.environ.get("UPLOAD_CHUNK_SIZE", str(64 * 1024)))
+MAX_UPLOAD_SIZE = int(os.environ.get("MAX_UPLOAD_SIZE", str(10 * 1024 * 1024)))
+# directory levels of two hex digits each above every stored image
+IMAGE_SHARD_DEPTH = int(os.environ.get("IMAGE_SHARD_DEPTH", "2"))
+
+# <sha256>.jpg and its variants, <sha256>_<size>.jpg
+STORED_NAME = re.compile(r"^[0-9a-f]{64}(_[a-z]+)?\.jpg$")
+SHARD_NAME = re.compile(r"^[0-9a-f]{2}$")
+
+
+def _current_umask() -> int:
+    # the umask can only be read by replacing it, so this runs once, at import
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+# tempfile.mkstemp creates files as 0600; stored files get the mode open() would have given them
+FILE_MODE = 0o666 & ~_current_umask()
+
+
+class UploadTooLarge(ValueError):
+    pass
+
+
+def _read_chunks(src: BinaryIO, max_size: int, chunk_size: int):
+    size = 0
+    while True:
+        chunk = src.read(chunk_size)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > max_size:
+            raise UploadTooLarge(f"image is larger than {max_size} bytes")
+        yield chunk
+
+
+def _hash_stream(src: BinaryIO, max_size: int, chunk_size: int) -> str:
+    digest = hashlib.sha256()
+    for chunk in _read_chunks(src, max_size, chunk_size):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ImageStore:
+    """Uploaded images, stored by content hash under hash-prefix shard directories.
+
+    With the default depth of 2, <sha256>.jpg and its variants live in
+    <sha256[0:2]>/<sha256[2:4]>/. Names that are not content hashes (the
+    placeholder) stay at the top level, as does everything in a depth 0 store.
+    Files left at the top level by the older flat layout are still found, and
+    migrate() moves them into their shards while the app keeps serving.
+    """
+
+    def __init__(self, root: pathlib.Path, depth: int = IMAGE_SHARD_DEPTH):
+        self.root = root
+        self.depth = depth
+
+    def path(self, name: str) -> pathlib.Path:
+        # where name is stored in this layout, whether or not it exists yet
+        if self.depth and STORED_NAME.match(name):
+            shards = [name[2 * level:2 * level + 2] for level in range(self.depth)]
+            return self.root.joinpath(*shards, name)
+        return self.root / name
+
+    def locate(self, name: str) -> Optional[pathlib.Path]:
+        # the sharded path is checked again after the flat one in case migrate() moved it in between
+        path = self.path(name)
+        if path.exists():
+            return path
+        flat = self.root / name
+        if flat != path and flat.exists():
+            return flat
+        return path if path.exists() else None
+
+    def save(self, src: BinaryIO, max_size: int = MAX_UPLOAD_SIZE, chunk_size: int = UPLOAD_CHUNK_SIZE) -> str:
+        """Store an image as <sha256>.jpg, reading at most chunk_size bytes at a time.
+
+        Seekable sources are hashed first so an image that is already stored is
+        never written again. Other sources are written to a temp file while being
+        hashed. Either way the file only appears under its final name through an
+        atomic rename.
+        """
+        if src.seekable():
+            start = src.tell()
+            name = f"{_hash_stream(src, max_size, chunk_size)}.jpg"
+            if self._keep(name):
+                return name
+            src.seek(start)
+
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=".upload-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as out:
+                os.fchmod(out.fileno(), FILE_MODE)
+                for chunk in _read_chunks(src, max_size, chunk_size):
+                    digest.update(chunk)
+                    out.write(chunk)
+            name = f"{digest.hexdigest()}.jpg"
+            if not self._keep(name):
+                target = self.path(name)
+                target.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(tmp_path, target)
+            return name
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    def _keep(self, name: str) -> bool:
+        # an upload of a stored image refreshes its mtime, which keeps the garbage
+        # collector away from it until the item that references it has committed
+        path = self.locate(name)
+        if path is None:
+            return False
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def files(self) -> Iterator[Tuple[str, pathlib.Path]]:
+        # every stored image and variant, flat leftovers first, then shard by shard
+        for entry in os.scandir(self.root):
+            if entry.is_file() and STORED_NAME.match(entry.name):
+                yield entry.name, pathlib.Path(entry.path)
+        yield from self._walk(self.root, self.depth)
+
+    def _walk(self, directory: pathlib.Path, depth: int) -> Iterator[Tuple[str, pathlib.Path]]:
+        if depth == 0:
+            return
+        for entry in sorted(os.scandir(directory), key=lambda entry: entry.name):
+            if not (entry.is_dir() and SHARD_NAME.match(entry.name)):
+                continue
+            if depth == 1:
+                for file in os.scandir(entry.path):
+                    if file.is_file() and STORED_NAME.match(file.name):
+                        yield file.name, pathlib.Path(file.path)
+            else:
+                yield from self._walk(pathlib.Path(entry.path), depth - 1)
+
+    def migrate(self, limit: Optional[int] = None) -> int:
+        # move flat-layout files into their shards; returns how many were moved
+        if not self.depth:
+            return 0
+        moved = 0
+        for entry in os.scandir(self.root):
+            if limit is not None and moved >= limit:
+                break
+            if not (entry.is_file() and STORED_NAME.match(entry.name)):
+                continue
+            target = self.path(entry.name)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(entry.path, target)
+            moved += 1
+        return moved
+
+
+def save_image(
+    src: BinaryIO,
+    directory: pathlib.Path,
+    max_size: int = MAX_UPLOAD_SIZE,
+    chunk_size: int = UPLOAD_CHUNK_SIZE,
+) -> str:
+    # flat <directory>/<sha256>.jpg; the app stores through an ImageStore instead
+    return ImageStore(directory, depth=0).save(src, max_size, chunk_size)
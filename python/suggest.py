@@ -0,0 +1,266 @@
+import os
+import sys
+import json
+import bisect
+import heapq
+import logging
+import pathlib
+import sqlite3
+import tempfile
+import threading
+import unicodedata
+from collections import Counter
+from typing import Dict, Iterable, List, Tuple
+
+from database import SELECT_ITEMS, SUGGEST_ITEM_NAMES, SUGGEST_CATEGORY_NAMES
+
+logger = logging.getLogger("uvicorn")
+
+SUGGEST_DEFAULT_LIMIT = 10
+SUGGEST_MAX_LIMIT = 20
+# prefixes matching more terms than this keep a ranked top list instead of being scanned per request
+SUGGEST_SCAN_LIMIT = int(os.environ.get("SUGGEST_SCAN_LIMIT", "512"))
+# cached top lists for prefixes up to this length are ranked up front rather than on first use
+SUGGEST_WARM_DEPTH = 2
+SNAPSHOT_FORMAT = 1
+
+# sorts after every character, so prefix + END bounds the terms starting with prefix
+END = "\U0010ffff"
+
+
+def normalize(text: str) -> str:
+    # NFKC folds full-width/half-width forms, casefold folds case; a trailing space is
+    # kept so "black " only completes to names with another word after "black"
+    folded = " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+    return folded + " " if folded and text[-1:].isspace() else folded
+
+
+class PrefixIndex:
+    """Item and category names with their item counts, for typeahead.
+
+    Terms live in one sorted list, so the completions of a prefix are a contiguous
+    slice found by bisection. Short prefixes match too many terms to rank on every
+    keystroke; those keep their top terms cached. Counts only ever grow, so the
+    cached lists stay exact as new items are counted.
+    """
+
+    def __init__(self, scan_limit: int = SUGGEST_SCAN_LIMIT, top_size: int = SUGGEST_MAX_LIMIT):
+        self.scan_limit = scan_limit
+        self.top_size = top_size
+        self._terms: List[str] = []
+        self._counts: Dict[str, int] = {}
+        # original spelling, only for terms where it differs from the normalized one
+        self._display: Dict[str, str] = {}
+        # prefix -> [(-count, term), ...] best first
+        self._tops: Dict[str, List[Tuple[int, str]]] = {}
+        self._text_bytes = 0
+        # highest items.id counted so far
+        self.watermark = 0
+        self._lock = threading.Lock()
+        # serializes catch-ups so each committed row is counted once
+        self._update_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._terms)
+
+    def clear(self):
+        with self._update_lock, self._lock:
+            self._reset([], {}, {}, 0)
+
+    def _reset(self, terms: List[str], counts: Dict[str, int], display: Dict[str, str], watermark: int):
+        self._terms, self._counts, self._display = terms, counts, display
+        self._tops = {}
+        self._text_bytes = sum(map(sys.getsizeof, terms)) + sum(map(sys.getsizeof, display.values()))
+        self.watermark = watermark
+        # the first keystrokes match the most terms, so rank those now instead of on the first request
+        prefixes = {term[:end] for term in terms for end in range(1, min(len(term), SUGGEST_WARM_DEPTH) + 1)}
+        for prefix in prefixes:
+            lo = bisect.bisect_left(terms, prefix)
+            hi = bisect.bisect_left(terms, prefix + END, lo)
+            if hi - lo > self.scan_limit:
+                self._tops[prefix] = self._rank(lo, hi, self.top_size)
+
+    def suggest(self, prefix: str, limit: int = SUGGEST_DEFAULT_LIMIT) -> List[Tuple[str, int]]:
+        key = normalize(prefix)
+        if not key:
+            return []
+        limit = min(limit, self.top_size)
+        with self._lock:
+            top = self._tops.get(key)
+            if top is None:
+                lo = bisect.bisect_left(self._terms, key)
+                hi = bisect.bisect_left(self._terms, key + END, lo)
+                if hi - lo <= self.scan_limit:
+                    return self._present(self._rank(lo, hi, limit))
+                top = self._tops[key] = self._rank(lo, hi, self.top_size)
+            return self._present(top[:limit])
+
+    def _rank(self, lo: int, hi: int, limit: int) -> List[Tuple[int, str]]:
+        counts = self._counts
+        return heapq.nsmallest(limit, ((-counts[term], term) for term in self._terms[lo:hi]))
+
+    def _present(self, ranked: List[Tuple[int, str]]) -> List[Tuple[str, int]]:
+        return [(self._display.get(term, term), -negative) for negative, term in ranked]
+
+    def add(self, texts: Iterable[Tuple[str, int]]):
+        # texts are (name, how many more items carry it)
+        merged: Dict[str, int] = {}
+        spellings: Dict[str, str] = {}
+        for text, count in texts:
+            key = normalize(text)
+            if key:
+                merged[key] = merged.get(key, 0) + count
+                spellings.setdefault(key, text)
+        with self._lock:
+            new_terms = []
+            for key, count in merged.items():
+                total = self._counts.get(key, 0) + count
+                if total == count:
+                    new_terms.append(key)
+                    self._text_bytes += sys.getsizeof(key)
+                    if spellings[key] != key:
+                        self._display[key] = spellings[key]
+                        self._text_bytes += sys.getsizeof(spellings[key])
+                self._counts[key] = total
+                self._bump_tops(key, total)
+            if len(new_terms) < 64:
+                for key in new_terms:
+                    bisect.insort(self._terms, key)
+            else:
+                # two sorted runs, which the sort merges in linear time
+                new_terms.sort()
+                self._terms.extend(new_terms)
+                self._terms.sort()
+
+    def _bump_tops(self, key: str, count: int):
+        for end in range(1, len(key) + 1):
+            top = self._tops.get(key[:end])
+            if top is None:
+                continue
+            for i, (_, term) in enumerate(top):
+                if term == key:
+                    del top[i]
+                    break
+            else:
+                if len(top) >= self.top_size and (-count, key) > top[-1]:
+                    continue
+            bisect.insort(top, (-count, key))
+            del top[self.top_size:]
+
+    def build(self, conn: sqlite3.Connection):
+        # one read transaction so the counts and the watermark describe the same rows
+        with self._update_lock:
+            in_transaction = conn.in_transaction
+            if not in_transaction:
+                conn.execute("BEGIN")
+            try:
+                watermark = conn.execute("SELECT COALESCE(MAX(id), 0) FROM items").fetchone()[0]
+                rows = conn.execute(SUGGEST_ITEM_NAMES).fetchall() + conn.execute(SUGGEST_CATEGORY_NAMES).fetchall()
+            finally:
+                if not in_transaction:
+                    conn.rollback()
+            counts: Dict[str, int] = {}
+            display: Dict[str, str] = {}
+            for text, count in rows:
+                key = normalize(text)
+                if not key:
+                    continue
+                counts[key] = counts.get(key, 0) + count
+                if key != text:
+                    display.setdefault(key, text)
+            with self._lock:
+                self._reset(sorted(counts), counts, display, watermark)
+        logger.info("Built the suggestion index: %s terms from %s items", len(counts), watermark)
+
+    def catch_up(self, conn: sqlite3.Connection) -> int:
+        # count the items committed since the last catch-up; returns how many there were
+        with self._update_lock:
+            last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM items").fetchone()[0]
+            if last_id < self.watermark:
+                # the database was replaced or truncated underneath us
+                watermark = self.watermark
+                with self._lock:
+                    self._reset([], {}, {}, 0)
+                logger.warning("Items table is behind the suggestion index (%s < %s), recounting", last_id, watermark)
+            texts: Counter = Counter()
+            added = 0
+            for item_id, name, category, _ in conn.execute(SELECT_ITEMS, (self.watermark, -1)):
+                texts[name] += 1
+                texts[category] += 1
+                self.watermark = item_id
+                added += 1
+            if texts:
+                self.add(texts.items())
+            return added
+
+    def save(self, path: pathlib.Path, conn: sqlite3.Connection):
+        # the name of the watermark item identifies the database the snapshot belongs to
+        with self._update_lock:
+            row = conn.execute("SELECT name FROM items WHERE id = ?", (self.watermark,)).fetchone()
+            with self._lock:
+                terms = [
+                    [term, self._counts[term], self._display[term]] if term in self._display else [term, self._counts[term]]
+                    for term in self._terms
+                ]
+                snapshot = {
+                    "format": SNAPSHOT_FORMAT,
+                    "watermark": self.watermark,
+                    "watermark_name": row[0] if row else None,
+                    "terms": terms,
+                }
+            fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=".tmp-", suffix=".json")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(snapshot, f, ensure_ascii=False, separators=(",", ":"))
+                os.replace(tmp, path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+
+    def load(self, path: pathlib.Path, conn: sqlite3.Connection) -> bool:
+        """Restore a snapshot written by save() and count what was committed after it.
+
+        Returns False, leaving the index untouched, when there is no usable
+        snapshot for this database.
+        """
+        try:
+            with open(path) as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable suggestion snapshot %s: %s", path, e)
+            return False
+        if snapshot.get("format") != SNAPSHOT_FORMAT:
+            return False
+        watermark = snapshot["watermark"]
+        row = conn.execute("SELECT name FROM items WHERE id = ?", (watermark,)).fetchone()
+        if (row[0] if row else None) != snapshot["watermark_name"]:
+            logger.info("Suggestion snapshot %s belongs to another database, rebuilding", path)
+            return False
+        terms = [entry[0] for entry in snapshot["terms"]]
+        counts = {entry[0]: entry[1] for entry in snapshot["terms"]}
+        display = {entry[0]: entry[2] for entry in snapshot["terms"] if len(entry) > 2}
+        with self._update_lock, self._lock:
+            self._reset(terms, counts, display, watermark)
+        added = self.catch_up(conn)
+        logger.info("Loaded %s suggestion terms from %s, %s newer items counted", len(terms), path, added)
+        return True
+
+    def memory_bytes(self) -> int:
+        # the lists and dicts themselves, the term strings and the counts (ints above 256 are objects)
+        with self._lock:
+            size = sys.getsizeof(self._terms) + sys.getsizeof(self._counts) + sys.getsizeof(self._display)
+            size += self._text_bytes + sys.getsizeof(1 << 10) * len(self._counts)
+            size += sys.getsizeof(self._tops)
+            for top in self._tops.values():
+                size += sys.getsizeof(top) + sys.getsizeof((0, "")) * len(top)
+        return size
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "terms": len(self._terms),
+            "cached_prefixes": len(self._tops),
+            "watermark": self.watermark,
+            "memory_bytes": self.memory_bytes(),
+        }
@@ -0,0 +1,180 @@
+import os
+import time
+import queue
+import logging
+import sqlite3
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from database import ConnectionPool
+
+logger = logging.getLogger("uvicorn")
+
+# Writes queued while a batch commits form the next batch. A batch closes when
+# it is full, or WRITER_MAX_DELAY after its first write if more time is allowed
+# to gather writes (0 commits whatever is queued right away).
+WRITER_MAX_BATCH = int(os.environ.get("WRITER_MAX_BATCH", "256"))
+WRITER_MAX_DELAY = float(os.environ.get("WRITER_MAX_DELAY", "0"))
+
+Write = Callable[[sqlite3.Connection], Any]
+
+_STOP = object()
+
+
+class SingleWriter:
+    """Runs every write on one dedicated connection and commits them in groups.
+
+    Callers submit a function taking the connection; writes that arrive within
+    the batch window share one transaction (and one fsync). Each write runs in
+    its own savepoint, so a failing write only fails its own future.
+    """
+
+    def __init__(
+        self,
+        pool: ConnectionPool,
+        max_batch: int = WRITER_MAX_BATCH,
+        max_delay: float = WRITER_MAX_DELAY,
+    ):
+        self.pool = pool
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue: "queue.Queue" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._on_commit: List[Callable[[sqlite3.Connection, List[Any]], None]] = []
+
+        self.batches = 0
+        self.writes = 0
+        self.failed_writes = 0
+        self.batch_size_max = 0
+        self.commit_seconds_total = 0.0
+        self.commit_seconds_max = 0.0
+
+    def on_commit(self, callback: Callable[[sqlite3.Connection, List[Any]], None]):
+        # called on the writer thread with the writer's connection and the results of
+        # each committed batch, so callbacks never wait for a pooled connection
+        self._on_commit.append(callback)
+
+    def submit(self, write: Write) -> Future:
+        future: Future = Future()
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="sqlite-writer", daemon=True)
+                self._thread.start()
+            self._queue.put((write, future))
+        return future
+
+    def stop(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+            if thread is None:
+                return
+            self._queue.put(_STOP)
+        thread.join()
+
+    def _collect(self, first) -> Tuple[List[Tuple[Write, Future]], bool]:
+        batch = [first]
+        deadline = time.perf_counter() + self.max_delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                entry = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if entry is _STOP:
+                return batch, True
+            batch.append(entry)
+        return batch, False
+
+    def _run(self):
+        try:
+            # opened outside the pool so the writer never takes a connection from readers
+            conn = self.pool.connect()
+        except Exception as e:
+            logger.error(f"Writer could not get a database connection: {e}")
+            with self._lock:
+                self._thread = None
+                self._fail_queued(e)
+            return
+        try:
+            stopping = False
+            while not stopping:
+                entry = self._queue.get()
+                if entry is _STOP:
+                    break
+                batch, stopping = self._collect(entry)
+                self._commit(conn, batch)
+        finally:
+            conn.close()
+
+    def _fail_queued(self, error: BaseException):
+        while True:
+            try:
+                entry = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if entry is not _STOP and entry[1].set_running_or_notify_cancel():
+                entry[1].set_exception(error)
+
+    def _commit(self, conn: sqlite3.Connection, batch: List[Tuple[Write, Future]]):
+        results: List[Tuple[Future, Any, Optional[BaseException]]] = []
+        start = time.perf_counter()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for write, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                conn.execute("SAVEPOINT write")
+                try:
+                    result = write(conn)
+                except Exception as e:
+                    conn.execute("ROLLBACK TO write")
+                    results.append((future, None, e))
+                else:
+                    results.append((future, result, None))
+                conn.execute("RELEASE write")
+            conn.commit()
+        except Exception as e:
+            logger.error(f"Group commit of {len(batch)} writes failed: {e}")
+            if conn.in_transaction:
+                conn.rollback()
+            for _, future in batch:
+                if future.running() or (not future.done() and future.set_running_or_notify_cancel()):
+                    future.set_exception(e)
+            return
+        elapsed = time.perf_counter() - start
+
+        committed = [result for _, result, error in results if error is None]
+        with self._lock:
+            self.batches += 1
+            self.writes += len(committed)
+            self.failed_writes += len(results) - len(committed)
+            self.batch_size_max = max(self.batch_size_max, len(results))
+            self.commit_seconds_total += elapsed
+            self.commit_seconds_max = max(self.commit_seconds_max, elapsed)
+
+        for callback in self._on_commit:
+            try:
+                callback(conn, committed)
+            except Exception as e:
+                logger.error(f"Commit callback failed: {e}")
+        # acknowledge callers only after the batch is durable and the callbacks have run
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "batches": self.batches,
+                "writes": self.writes,
+                "failed_writes": self.failed_writes,
+                "batch_size_avg": (self.writes + self.failed_writes) / self.batches if self.batches else 0.0,
+                "batch_size_max": self.batch_size_max,
+                "commit_seconds_total": self.commit_seconds_total,
+                "commit_seconds_max": self.commit_seconds_max,
+                "queued": self._queue.qsize(),
+            }